@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+    """Options of the shared Kentik api client, see module_utils/kentik_client.py"""
+
+    DOCUMENTATION = r"""
+options:
+    region:
+        description: The reqion that your Kentik portal is located in.
+        type: str
+        default: US
+        choices: [ US, EU ]
+    rateLimitFile:
+        description:
+        - File holding the Kentik rate limit state, shared by every task talking to the same Kentik account.
+        - Defaults to a file per account and region in a directory of the temporary directory
+          private to the user running the module.
+        type: path
+    collectTimings:
+        description:
+        - Record the latency, bytes and retries of every http request and the time spent in each phase
+          of the run, such as fetching, building, uploading and polling, and return them under I(timings).
+        type: bool
+        default: false
+    token:
+        description: The Kentik API Token used to authenticate.
+        type: str
+        required: true
+    email:
+        description: The Kentik API Email used to authenticate.
+        type: str
+        required: true
+"""
+
+    CATALOG_CACHE = r"""
+options:
+    catalogCacheTtl:
+        description:
+        - Number of seconds the Kentik catalogs (sites, labels, plans and devices) are reused once fetched.
+        - The cache is shared by every task on the host running the module, set to 0 to fetch the catalogs every time.
+        type: int
+        default: 0
+    catalogCacheRevalidate:
+        description: Revalidate an expired catalog with its ETag instead of downloading it again.
+        type: bool
+        default: false
+    catalogCacheDir:
+        description:
+        - Directory holding the cached catalogs, defaults to a directory of the temporary directory
+          private to the user running the module.
+        - The directory must belong to the user running the module and give no permissions to the group or others.
+        type: path
+"""
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""On-disk cache of the Kentik catalogs (sites, labels, plans, devices) shared by every module run on the controller."""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+from ansible.module_utils._text import to_text
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_paths import private_dir, user_temp_dir
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+class CatalogCache:
+    """Catalog listings cached on disk for a time to live.
+
+    Each listing is kept in its own file next to a lock file. The lock is held
+    while the listing is checked and fetched, so when many forks ask for the
+    same expired listing one of them fetches it and the others read its copy.
+    """
+
+    def __init__(self, module):
+        self.ttl = module.params.get("catalogCacheTtl") or 0
+        self.revalidate = module.params.get("catalogCacheRevalidate") or False
+        self.path = module.params.get("catalogCacheDir") or user_temp_dir("kentik_catalog")
+        # Catalogs differ per account, so the account is part of every key.
+        self.account = f"{module.params['email']}@{module.params['region']}"
+        if self.enabled:
+            # The cached listings decide site, plan and label ids, so nobody else may write them.
+            try:
+                private_dir(self.path)
+            except OSError as exc:
+                module.fail_json(msg=f"Unable to use the catalog cache directory: {to_text(exc)}")
+
+    @property
+    def enabled(self):
+        """Return True when catalogs are cached"""
+        return self.ttl > 0
+
+    def entry_path(self, url):
+        """Return the file of the cached listing for a url"""
+        key = hashlib.sha256(f"{self.account} {url}".encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{key}.json")
+
+    def locked(self, url, action):
+        """Run action with the lock of the listing for a url held"""
+        entry_path = self.entry_path(url)
+        with open(f"{entry_path}.lock", "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return action(entry_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, client, url):
+        """Return the json listing at the url, from the cache while it is fresh"""
+        if not self.enabled:
+            return client.request("GET", url).json()
+
+        def fetch(entry_path):
+            entry = read_entry(entry_path)
+            now = time.time()
+            if entry is not None and now - entry["fetched"] < self.ttl:
+                logging.info("Using the cached catalog for url: %s", url)
+                return entry["data"]
+            headers = None
+            if entry is not None and self.revalidate and entry.get("etag"):
+                headers = {"If-None-Match": entry["etag"]}
+            response = client.request("GET", url, headers=headers, not_modified_ok=True)
+            if response.status_code == 304:
+                logging.info("The cached catalog is still current for url: %s", url)
+            else:
+                entry = {"url": url, "etag": response.headers.get("ETag"), "data": response.json()}
+            entry["fetched"] = now
+            write_entry(entry_path, entry)
+            return entry["data"]
+        return self.locked(url, fetch)
+
+    def invalidate(self, url):
+        """Drop the cached listing for a url after it was changed"""
+        if not self.enabled:
+            return
+
+        def remove(entry_path):
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+        self.locked(url, remove)
+
+
+def read_entry(entry_path):
+    """Return a cached listing, None when missing or unreadable"""
+    try:
+        with open(entry_path, encoding="utf-8") as entry_file:
+            return json.load(entry_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_entry(entry_path, entry):
+    """Write a cached listing, replacing the file atomically"""
+    descriptor = os.open(f"{entry_path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w", encoding="utf-8") as entry_file:
+        json.dump(entry, entry_file)
+    os.replace(f"{entry_path}.tmp", entry_path)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""Shared Kentik api client used by the modules of this collection."""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+from ansible.module_utils.basic import missing_required_lib
+from ansible.module_utils._text import to_text
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_catalog import CatalogCache
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_rate_limit import RateLimiter, rate_limit_path
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_timings import Timings
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import traceback
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    HAS_REQUESTS = False
+    REQUESTS_IMPORT_ERROR = traceback.format_exc()
+else:
+    HAS_REQUESTS = True
+    REQUESTS_IMPORT_ERROR = None
+
+# Base urls of the grpc (v202x) and v5 apis for each region.
+GRPC_URLS = {"US": "https://grpc.api.kentik.com", "EU": "https://grpc.api.kentik.eu"}
+API_URLS = {"US": "https://api.kentik.com/api/v5", "EU": "https://api.kentik.eu/api/v5"}
+# Environment variable pointing both apis at one other host, such as the stand-in server under tests/benchmarks.
+BASE_URL_ENV = "KENTIK_BASE_URL"
+# Options of the client shared by every module, documented in the kentik_client doc fragment.
+CLIENT_ARGUMENT_SPEC = dict(
+    email=dict(type="str", required=True),
+    token=dict(type="str", no_log=True, required=True),
+    region=dict(type="str", required=False, default="US", choices=["US", "EU"]),
+    rateLimitFile=dict(type="path", required=False),
+    collectTimings=dict(type="bool", required=False, default=False),
+)
+# Options of the catalog cache, documented in the kentik_client.catalog_cache doc fragment.
+CATALOG_CACHE_ARGUMENT_SPEC = dict(
+    catalogCacheTtl=dict(type="int", required=False, default=0),
+    catalogCacheRevalidate=dict(type="bool", required=False, default=False),
+    catalogCacheDir=dict(type="path", required=False),
+)
+# How many times a throttled request is sent again before giving up.
+THROTTLE_RETRIES = 3
+# Spooled request bodies stay in memory up to this size and move to a temporary file beyond it.
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+# Spooled request bodies are read back in blocks of this size while they are sent.
+SPOOL_READ_BYTES = 64 * 1024
+
+
+def client_argument_spec(catalog_cache=True):
+    """Return a copy of the client options to add to the argument spec of a module"""
+    argument_spec = copy.deepcopy(CLIENT_ARGUMENT_SPEC)
+    if catalog_cache:
+        argument_spec.update(copy.deepcopy(CATALOG_CACHE_ARGUMENT_SPEC))
+    return argument_spec
+
+
+def payload_params(module, exclude=()):
+    """Return a copy of the module parameters without the client options and the excluded keys"""
+    excluded = set(CLIENT_ARGUMENT_SPEC) | set(CATALOG_CACHE_ARGUMENT_SPEC) | set(exclude)
+    return {key: copy.deepcopy(value) for key, value in module.params.items() if key not in excluded}
+
+
+def build_kentik_auth(module):
+    """Build the kentik auth dictionary for headers"""
+    kentik_auth = {
+        "X-CH-Auth-Email": module.params["email"],
+        "X-CH-Auth-API-Token": module.params["token"],
+        "Content-Type": "application/json",
+    }
+    return kentik_auth
+
+
+class SpooledBody:
+    """A request body written from an iterator of bytes into a spooled temporary file.
+
+    The body knows its length, so it goes out with a Content-Length header rather
+    than chunked transfer encoding, and it is read again from the start when a
+    throttled request is sent again.
+    """
+
+    def __init__(self, chunks, max_memory=SPOOL_MEMORY_BYTES):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        for chunk in chunks:
+            self.file.write(chunk)
+        self.size = self.file.tell()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        self.file.seek(0)
+        return iter(functools.partial(self.file.read, SPOOL_READ_BYTES), b"")
+
+    def close(self):
+        """Release the memory or temporary file holding the body"""
+        self.file.close()
+
+
+def fail_once(module):
+    """Make sure only the first of several concurrent failures is reported back to ansible.
+
+    module.failing is set as soon as the module fails, so work still queued on
+    other threads can be skipped with run_concurrently.
+    """
+    fail_json = module.fail_json
+    lock = threading.Lock()
+    module.failing = threading.Event()
+
+    def fail_json_once(**kwargs):
+        if lock.acquire(blocking=False):
+            module.failing.set()
+            fail_json(**kwargs)
+        # Another thread is already failing the module, stop this one quietly.
+        raise SystemExit(1)
+    module.fail_json = fail_json_once
+
+
+def run_concurrently(module, max_workers, calls):
+    """Run the calls on a thread pool and return their results in order.
+
+    Once the module fails, the calls that have not started yet are cancelled or
+    skipped, so nothing more is sent to kentik after the failure was reported.
+    The module must have been set up with fail_once.
+    """
+    def guarded(call):
+        if module.failing.is_set():
+            raise SystemExit(1)
+        return call()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(guarded, call) for call in calls]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            module.failing.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+
+class KentikClient:
+    """Kentik api client sending every request over one pooled keep-alive session"""
+
+    def __init__(self, module, pool_size=10, timeout=30):
+        if not HAS_REQUESTS:
+            module.fail_json(msg=missing_required_lib("requests"), exception=REQUESTS_IMPORT_ERROR)
+        self.module = module
+        self.timeout = timeout
+        self.grpc_base = GRPC_URLS[module.params["region"]]
+        self.api_base = API_URLS[module.params["region"]]
+        if os.environ.get(BASE_URL_ENV):
+            self.grpc_base = os.environ[BASE_URL_ENV].rstrip("/")
+            self.api_base = f"{self.grpc_base}/api/v5"
+        self.session = requests.Session()
+        self.session.headers.update(build_kentik_auth(module))
+        # Connections are kept alive and reused, pool_size should cover the threads sharing the client.
+        # Failed connection attempts are retried, a request that reached kentik is never sent twice here.
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=3)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        try:
+            self.limiter = RateLimiter(rate_limit_path(module))
+        except OSError as exc:
+            module.fail_json(msg=f"Unable to use the rate limit state file: {to_text(exc)}")
+        self.catalogs = CatalogCache(module)
+        self.timings = Timings(module.params.get("collectTimings"))
+
+    def grpc_url(self, path):
+        """Return the url of a path on the grpc api, e.g. /site/v202211/sites"""
+        return f"{self.grpc_base}{path}"
+
+    def api_url(self, path):
+        """Return the url of a path on the v5 api, e.g. /plans"""
+        return f"{self.api_base}{path}"
+
+    def send(self, method, url, data=None, headers=None):
+        """Send a request, waiting out throttling, and return the response whatever its status"""
+        # Streamed bodies can only be read once so they are not sent again after a 429.
+        retryable = data is None or isinstance(data, (str, bytes, dict, SpooledBody))
+        retries = 0
+        throttle_seconds = 0
+        sent = {"bytes": 0}
+        if self.timings.enabled:
+            data = self.timings.count_body(data, sent)
+        started = time.monotonic()
+        response = None
+        try:
+            while True:
+                # Every request waits for a token of the limiter shared with the other forks.
+                throttle_seconds += self.limiter.acquire()
+                response = self.session.request(method, url, data=data, headers=headers, timeout=self.timeout)
+                throttled = response.status_code == 429
+                self.limiter.update(response.headers, throttled)
+                if not throttled or not retryable or retries >= THROTTLE_RETRIES:
+                    break
+                retries += 1
+                logging.info("Throttled on %s %s, retrying after the rate limit resets", method, url)
+        finally:
+            if self.timings.enabled:
+                self.timings.record_request(method, url,
+                                            response.status_code if response is not None else None,
+                                            time.monotonic() - started - throttle_seconds,
+                                            sent["bytes"],
+                                            len(response.content) if response is not None else 0,
+                                            retries,
+                                            throttle_seconds)
+        return response
+
+    def request(self, method, url, payload=None, data=None, headers=None, missing_ok=False, not_modified_ok=False):
+        """Send a request and return the response, failing the module on any error.
+
+        payload is serialized to json, data is sent as is. When missing_ok is set
+        a 404 returns None instead of failing, and when not_modified_ok is set a
+        304 answer to a conditional request is returned as is.
+        """
+        if payload is not None:
+            data = json.dumps(payload)
+        try:
+            response = self.send(method, url, data=data, headers=headers)
+        except (ConnectionError, requests.exceptions.RequestException) as exc:
+            self.module.fail_json(msg=to_text(exc))
+        if response.status_code == 404 and missing_ok:
+            return None
+        if response.status_code == 304 and not_modified_ok:
+            return response
+        if response.status_code < 200 or response.status_code >= 300:
+            self.module.fail_json(msg=response.text)
+        logging.info("%s HTTP Request Successfull for url: %s", method, url)
+        return response
+
+    def catalog(self, url):
+        """Return the json of a catalog listing such as the sites or labels, cached when enabled"""
+        return self.catalogs.get(self, url)
+
+    def invalidate_catalog(self, url):
+        """Forget the cached catalog listing at the url after changing it"""
+        self.catalogs.invalidate(url)
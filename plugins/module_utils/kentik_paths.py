@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""Private directories on the controller for the state shared by the module runs of one user."""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import os
+import stat
+import tempfile
+
+
+def user_temp_dir(name):
+    """Return a directory in the temporary directory named after the current user, e.g. /tmp/kentik_catalog_1000"""
+    return os.path.join(tempfile.gettempdir(), f"{name}_{os.getuid()}")
+
+
+def private_dir(path):
+    """Create the directory for the current user only, raises PermissionError when an existing one is not private.
+
+    Anyone can create a directory in the temporary directory first, so an
+    existing one must belong to the current user and give no access to others.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory owned by the current user "
+                              "with no permissions for the group or others")
+    return path
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""Client side Kentik rate limiter shared by every module run on the controller."""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_paths import private_dir, user_temp_dir
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+# How long to back off when kentik throttles a request without saying for how long.
+DEFAULT_RESET = 60
+# How long the other requests wait for the answer of the first request of an unknown window.
+PROBE_SECONDS = 2
+# How often the waiting requests check whether that answer arrived.
+PROBE_POLL_SECONDS = 0.1
+# How long requests go unpaced after a response came back without rate limit headers.
+UNTRACKED_SECONDS = 60
+
+
+def rate_limit_path(module):
+    """Return the limiter state file, one per kentik account and region unless set by the user.
+
+    The default files live in a directory private to the user running the module,
+    raises OSError when that directory cannot be created or is not private.
+    """
+    if module.params.get("rateLimitFile"):
+        return module.params["rateLimitFile"]
+    account = hashlib.sha256(f"{module.params['email']}@{module.params['region']}".encode("utf-8")).hexdigest()
+    return os.path.join(private_dir(user_temp_dir("kentik_rate_limit")), f"{account[:16]}.json")
+
+
+class RateLimiter:
+    """Token bucket fed by the x-ratelimit headers of kentik.
+
+    The bucket holds the requests kentik still allows before its limit resets.
+    Every request takes a token and every response puts the bucket back in line
+    with what kentik reported. When the bucket is empty the request waits for
+    the reset. The state lives in a file locked around each change, so every
+    Ansible fork and thread talking to the same account paces itself together.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Opened once up front so a missing directory is reported before any request, raises OSError.
+        os.close(self.open())
+
+    def open(self):
+        """Open the state file, created readable by the current user only and never through a symlink"""
+        return os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+
+    def read(self, state_file):
+        """Return the state held in the locked file"""
+        state_file.seek(0)
+        try:
+            return json.loads(state_file.read() or "{}")
+        except ValueError:
+            return {}
+
+    def write(self, state_file, state):
+        """Replace the state held in the locked file"""
+        state_file.seek(0)
+        state_file.truncate()
+        state_file.write(json.dumps(state))
+        state_file.flush()
+
+    def locked(self, change):
+        """Apply change to the state while holding the file lock and return its result"""
+        with os.fdopen(self.open(), "r+", encoding="utf-8") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state = self.read(state_file)
+                result = change(state, time.time())
+                self.write(state_file, state)
+                return result
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+
+    def take(self, state, now):
+        """Take a token, returns how long to wait first when the bucket is empty"""
+        reset_at = state.get("reset_at")
+        if reset_at is not None and now < reset_at:
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0
+            if state.get("probe"):
+                return min(reset_at - now, PROBE_POLL_SECONDS)
+            return reset_at - now
+        if state.get("untracked_until", 0) > now:
+            return 0
+        # Nothing is known about the current window, so this request goes ahead
+        # alone and the others wait for its answer to fill the bucket.
+        state.clear()
+        state.update(tokens=0, reset_at=now + PROBE_SECONDS, probe=True)
+        return 0
+
+    def acquire(self):
+        """Block until a request may be sent and return the seconds spent waiting"""
+        waited = 0
+        while True:
+            delay = self.locked(self.take)
+            if delay <= 0:
+                return waited
+            if delay > PROBE_POLL_SECONDS:
+                logging.info("Kentik rate limit reached, waiting %.1f seconds", delay)
+            time.sleep(delay)
+            waited += delay
+
+    def update(self, headers, throttled=False):
+        """Bring the bucket in line with the rate limit headers of a response"""
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        if throttled:
+            remaining = 0
+            reset = reset if reset is not None else DEFAULT_RESET
+
+        def change(state, now):
+            if remaining is None or reset is None:
+                if state.get("probe"):
+                    # Nothing to pace on, stop holding the other requests back.
+                    state.clear()
+                    state["untracked_until"] = now + UNTRACKED_SECONDS
+                return
+            reset_at = now + float(reset)
+            if state.pop("probe", False) or state.get("reset_at") is None or reset_at > state["reset_at"] + 1:
+                # First answer of a window, kentik knows best.
+                state["tokens"] = int(remaining)
+            else:
+                # Requests still in flight already took their tokens, so never hand any back.
+                state["tokens"] = min(state["tokens"], int(remaining))
+            state["reset_at"] = reset_at
+        self.locked(change)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""Opt-in timings of the http requests and phases of a module run, returned with the module result."""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import contextlib
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Path parts that vary between calls are folded so the same endpoint is reported under one name.
+ENDPOINT_PATTERNS = (
+    (re.compile(r"/customdimensions/[^/]+/populators$"), "/customdimensions/{dimension}/populators"),
+    (re.compile(r"/batch/[^/]+/status$"), "/batch/{guid}/status"),
+    (re.compile(r"/api/v5/device/[^/]+$"), "/api/v5/device/{device}"),
+    (re.compile(r"/\d+(?=/|$)"), "/{id}"),
+)
+
+
+def endpoint_template(url):
+    """Return the path of a url with its ids replaced by placeholders, e.g. /site/v202211/sites/{id}"""
+    path = urlsplit(url).path
+    for pattern, template in ENDPOINT_PATTERNS:
+        path = pattern.sub(template, path)
+    return path
+
+
+def body_size(body):
+    """Return the size of a request body that is in memory or knows its length, None for streamed bodies"""
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, bytes):
+        return len(body)
+    # Sized bodies such as a spooled batch body, dicts are form encoded by requests.
+    if hasattr(body, "__len__") and not isinstance(body, dict):
+        return len(body)
+    return None
+
+
+class Timings:
+    """Records every http request and the time spent in each phase of a module run.
+
+    Nothing is recorded unless enabled, so the hooks cost nothing on a normal run.
+    The records are shared by the threads of a module and returned under the
+    timings key of the result.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = bool(enabled)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = []
+        self.phases = {}
+
+    def count_body(self, body, sent):
+        """Return the body to send, streamed bodies are wrapped to add their bytes to sent["bytes"]"""
+        size = body_size(body)
+        if size is not None or isinstance(body, dict):
+            sent["bytes"] = size or 0
+            return body
+
+        def counted():
+            for chunk in body:
+                sent["bytes"] += len(chunk)
+                yield chunk
+        sent["bytes"] = 0
+        return counted()
+
+    def record_request(self, method, url, status, seconds, bytes_out, bytes_in, retries=0, throttle_seconds=0):
+        """Record one http request, seconds excludes the time spent waiting on the rate limit"""
+        if not self.enabled:
+            return
+        record = {"method": method,
+                  "endpoint": endpoint_template(url),
+                  "status": status,
+                  "seconds": round(seconds, 4),
+                  "bytes_out": bytes_out,
+                  "bytes_in": bytes_in,
+                  "retries": retries,
+                  "throttle_seconds": round(throttle_seconds, 4)}
+        with self.lock:
+            self.requests.append(record)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block as part of a phase such as fetch, build, upload or poll.
+
+        Phases entered from several threads add up, so a phase can report more
+        seconds than the run took when its work overlapped.
+        """
+        if not self.enabled:
+            yield
+            return
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            with self.lock:
+                phase = self.phases.setdefault(name, {"count": 0, "seconds": 0})
+                phase["count"] += 1
+                phase["seconds"] += seconds
+
+    def endpoints(self):
+        """Return the requests summed per method and endpoint"""
+        endpoints = {}
+        for record in self.requests:
+            key = f"{record['method']} {record['endpoint']}"
+            summary = endpoints.setdefault(key, {"count": 0, "seconds": 0, "max_seconds": 0,
+                                                 "bytes_out": 0, "bytes_in": 0,
+                                                 "retries": 0, "throttle_seconds": 0})
+            summary["count"] += 1
+            summary["seconds"] += record["seconds"]
+            summary["max_seconds"] = max(summary["max_seconds"], record["seconds"])
+            summary["bytes_out"] += record["bytes_out"]
+            summary["bytes_in"] += record["bytes_in"]
+            summary["retries"] += record["retries"]
+            summary["throttle_seconds"] += record["throttle_seconds"]
+        for summary in endpoints.values():
+            summary["seconds"] = round(summary["seconds"], 4)
+            summary["throttle_seconds"] = round(summary["throttle_seconds"], 4)
+        return endpoints
+
+    def report(self):
+        """Return the timings for the module result"""
+        with self.lock:
+            return {"seconds": round(time.monotonic() - self.started, 4),
+                    "phases": {name: {"count": phase["count"], "seconds": round(phase["seconds"], 4)}
+                               for name, phase in self.phases.items()},
+                    "endpoints": self.endpoints(),
+                    "requests": list(self.requests)}
@@ -89,11 +89,6 @@ options:
     deviceBgpFlowspec:
         description: Toggle BGP Flowspec Compatibility for device.
         type: bool
-    region:
-        description: The reqion that your Kentik portal is located in.
-        type: str
-        default: US
-        choices: [ US, EU ]
     nms:
         description:
         - A dictionary for adding NMS SNMP or streaming telemetry to a device.
@@ -104,18 +99,13 @@ options:
         type: str
         choices: [present, absent]
         default: present
-    token:
-        description: The Kentik API Token used to authenticate.
-        type: str
-        required: true
-    email:
-        description: The Kentik API Email used to authenticate.
-        type: str
-        required: true
     labels:
         description: Labels that get assigned to the device.
         type: list
         elements: str
+extends_documentation_fragment:
+- kentik.kentik_config.kentik_client
+- kentik.kentik_config.kentik_client.catalog_cache
 author:
 - Ethan Angele (@kentikethan)
 """
@@ -148,6 +138,16 @@ EXAMPLES = r"""
 
 RETURN = r"""
 # These are examples of possible return values, and in general should use other names for return values.
+timings:
+    description: The module run time and every http request with its latency, body bytes, retries and time
+                 waited on the rate limit, also summed per endpoint.
+    type: dict
+    returned: when collectTimings is enabled
+    sample: {"seconds": 0.9, "phases": {},
+             "endpoints": {"GET /device/v202308beta1/device": {"count": 1, "seconds": 0.31, "max_seconds": 0.31,
+                           "bytes_out": 0, "bytes_in": 20480, "retries": 0, "throttle_seconds": 0}},
+             "requests": [{"method": "GET", "endpoint": "/device/v202308beta1/device", "status": 200, "seconds": 0.31,
+                           "bytes_out": 0, "bytes_in": 20480, "retries": 0, "throttle_seconds": 0}]}
 original_message:
     description: The original name param that was passed in.
     type: str
@@ -160,34 +160,26 @@ message:
     sample: 'goodbye'
 """
 
-import json
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_text
-try:
-    import requests
-except ImportError:
-    HAS_ANOTHER_LIBRARY = False
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_client import (
+    KentikClient, client_argument_spec, payload_params)
 import logging
-import time
 
 
-def gather_labels(base_url, api_version, auth, module):
+def gather_labels(client, api_version):
     """Gather the current list of labels"""
-    url = f"{base_url}/label/{api_version}/labels"
-    payload = {}
-    headers = auth
-    response = http_request_func("GET", url, headers, payload, module)
-    label_data = response.json()
+    url = client.grpc_url(f"/label/{api_version}/labels")
+    label_data = client.catalog(url)
     label_dict = {}
     for label in label_data["labels"]:
         label_dict[label["name"]] = label["id"]
     return label_dict
 
 
-def build_labels(base_url, api_version, auth, module):
+def build_labels(client, api_version, module):
     """Function to build the list of labels to be added to a device"""
     api_version = "v202210"
-    current_labels = gather_labels(base_url, api_version, auth, module)
+    current_labels = gather_labels(client, api_version)
     label_ids = []
     for label in module.params["labels"]:
         if label in current_labels:
@@ -199,22 +191,18 @@ def build_labels(base_url, api_version, auth, module):
     return label_ids
 
 
-def gather_sites(base_url, api_version, auth, module):
+def gather_sites(client, api_version):
     """Gather a list of sites"""
-    url = f"{base_url}{api_version}/sites"
-    payload = {}
-    headers = auth
-    response = http_request_func("GET", url, headers, payload, module)
-    site_data = response.json()
+    url = client.grpc_url(f"{api_version}/sites")
+    site_data = client.catalog(url)
     site_dict = {}
     for site in site_data["sites"]:
         site_dict[site["title"]] = site["id"]
     return site_dict
 
 
-def compare_site(site_list, module):
+def compare_site(site_list, site):
     """Check to see if the site exists"""
-    site = module.params["title"]
     if site in site_list:
         logging.info("Site Exists")
         function_return = site_list[site]
@@ -224,28 +212,19 @@ def compare_site(site_list, module):
     return function_return
 
 
-def build_payload(base_url, auth, module):
+def build_payload(client, module):
     """Function to build the device object payload by removing unnecessary items."""
-    payload = module.params
-    del payload["email"]
-    del payload["token"]
-    del [payload["state"]]
-    payload["title"] = module.params["siteName"]
-    del [payload["siteName"]]
+    payload = payload_params(module, exclude=("state", "siteName", "planName", "labels", "updateSnmpAuth"))
+    site = module.params["siteName"]
     # REMEMBER TO PASS THE CORRECT API VERSION FOR SITES HERE
-    site_list = gather_sites(base_url, "/site/v202211", auth, module)
-    site_id = compare_site(site_list, module)
+    site_list = gather_sites(client, "/site/v202211")
+    site_id = compare_site(site_list, site)
     if site_id is False:
-        module.fail_json(msg=f"Site {payload['title']} does not exist.")
+        module.fail_json(msg=f"Site {site} does not exist.")
     payload["siteId"] = int(site_id)
-    plan_dict = gather_plans(auth, module)
+    plan_dict = gather_plans(client)
     plan_id = compare_plan(plan_dict, module)
     payload["planId"] = int(plan_id)
-    del [payload["planName"]]
-    del [payload["labels"]]
-    del [payload["title"]]
-    del [payload["region"]]
-    del [payload["updateSnmpAuth"]]
     none_keys = []
     for key in payload:
         if payload[key] is None:
@@ -258,47 +237,10 @@ def build_payload(base_url, auth, module):
     return payload
 
 
-def http_request_func(method, url, headers, payload, module, retries=0):
-    """Function for handling HTTP Requests"""
-    if retries < 3:
-        try:
-            response = requests.request(
-                method, url, headers=headers, data=payload, timeout=30
-            )
-            if response.status_code == 200:
-                logging.info("%s HTTP Request Successfull for url: %s", method, url)
-            elif response.status_code == 429:
-                if 'x-ratelimit-reset' in response.headers:
-                    time.sleep(int(response.headers['x-ratelimit-reset']))
-                else:
-                    time.sleep(60)
-                retries += 1
-                http_request_func(method, url, headers, payload, module, retries)
-            elif response.status_code == 404:
-                return False
-            else:
-                module.fail_json(msg=response.text)
-            if 'x-ratelimit-remaining' in response.headers:
-                if int(response.headers['x-ratelimit-remaining']) < 10:
-                    time.sleep(10)  # Helps to slow down the rate of execution for throttling.
-        except ConnectionError as exc:
-            module.fail_json(msg=to_text(exc))
-    else:
-        module.fail_json(msg="ERROR - RETRIED 3 TIMES")
-    return response
-
-
-def gather_plans(auth, module):
+def gather_plans(client):
     """Function to gather a list of existing plans"""
-    if module.params["region"] == "EU":
-        url = "https://api.kentik.eu/api/v5/plans"
-    else:
-        url = "https://api.kentik.com/api/v5/plans"
-    payload = {}
-    headers = auth
-    plan_data = ''
-    response = http_request_func("GET", url, headers, payload, module)
-    plan_data = response.json()
+    url = client.api_url("/plans")
+    plan_data = client.catalog(url)
     plan_dict = {}
     for plan in plan_data["plans"]:
         plan_dict[plan["name"]] = plan["id"]
@@ -316,13 +258,10 @@ def compare_plan(plan_dict, module):
     return plan_dict[plan]
 
 
-def gather_devices(base_url, api_version, auth, module):
+def gather_devices(client, api_version):
     """Function to gather a list of devices for comparison"""
-    url = f"{base_url}/device/{api_version}/device"
-    payload = {}
-    headers = auth
-    response = http_request_func("GET", url, headers, payload, module)
-    device_data = response.json()
+    url = client.grpc_url(f"/device/{api_version}/device")
+    device_data = client.catalog(url)
     device_dict = {}
     for device in device_data["devices"]:
         device_dict[device["deviceName"]] = device["id"]
@@ -341,13 +280,11 @@ def compare_device(device_list, module):
     return function_return
 
 
-def compare_labels(base_url, api_version, auth, module, device_id, labels):
+def compare_labels(client, api_version, device_id, labels):
     """Function to compare labels on a device to determine if it needs updated."""
-    url = f"{base_url}/device/{api_version}/device/{device_id}"
-    payload = {}
-    headers = auth
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}")
     function_return = ''
-    response = http_request_func("GET", url, headers, payload, module)
+    response = client.request("GET", url)
     device_data = response.json()
     device_labels = []
     for device_label in device_data["device"]["labels"]:
@@ -362,28 +299,22 @@ def compare_labels(base_url, api_version, auth, module, device_id, labels):
     return function_return
 
 
-def delete_device(base_url, api_version, auth, device_id, module):
+def delete_device(client, api_version, device_id):
     """Function to delete a device from Kentik"""
     logging.info("Archiving Device...")
-    url = f"{base_url}/device/{api_version}/device/{device_id}"
-    payload = {}
-    headers = auth
-    http_request_func("DELETE", url, headers, payload, module)
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}")
+    client.request("DELETE", url)
+    client.invalidate_catalog(client.grpc_url(f"/device/{api_version}/device"))
     logging.info("Device deleted successfully")
 
 
-def check_device(auth, module, region):
+def check_device(client, module):
     """Function to check if the device exists in kentik"""
     logging.info("Checking if the device needs updated...")
     device_name = module.params["deviceName"]
-    if region == "EU":
-        url = f"https://api.kentik.eu/api/v5/device/{device_name}"
-    else:
-        url = f"https://api.kentik.com/api/v5/device/{device_name}"
-    headers = auth
+    url = client.api_url(f"/device/{device_name}")
     device_data = {}
-    payload = {}
-    response = http_request_func("GET", url, headers, payload, module)
+    response = client.request("GET", url, missing_ok=True)
     if response:
         device_data['exists'] = True
         device_info = response.json()
@@ -393,42 +324,37 @@ def check_device(auth, module, region):
     return device_data
 
 
-def create_device(base_url, api_version, auth, module, device_object):
+def create_device(client, api_version, device_object):
     """Function to add a device to kentik"""
     logging.info("Creating Device...")
-    url = f"{base_url}/device/{api_version}/device"
-    payload = json.dumps({"device": device_object})
-    headers = auth
+    url = client.grpc_url(f"/device/{api_version}/device")
     device_data = ''
-    response = http_request_func("POST", url, headers, payload, module)
+    response = client.request("POST", url, payload={"device": device_object})
+    client.invalidate_catalog(url)
     device_data = response.json()
     return device_data["device"]["id"]
 
 
-def update_device_labels(base_url, api_version, auth, module, device_id, labels):
+def update_device_labels(client, api_version, device_id, labels):
     """Function to add or update device labels"""
     logging.info("Updating Device Labels...")
-    url = f"{base_url}/device/{api_version}/device/{device_id}/labels"
-    headers = auth
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}/labels")
     labels_list = []
     device_data = ''
     for label in labels:
         label_dict = {"id": int(label)}
         labels_list.append(label_dict)
-    payload = json.dumps({"id": device_id, "labels": labels_list})
-    response = http_request_func("PUT", url, headers, payload, module)
+    response = client.request("PUT", url, payload={"id": device_id, "labels": labels_list})
     device_data = response.json()
     return device_data["device"]["id"]
 
 
-def update_check(base_url, api_version, auth, module, device_id, device_object, update_bool):
+def update_check(client, api_version, device_id, device_object, update_bool):
     """Function to check whether a device needs to be updated"""
     logging.info("Checking device update...")
-    url = f"{base_url}/device/{api_version}/device/{device_id}"
-    headers = auth
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}")
     device_data = {}
-    payload = {}
-    response = http_request_func("GET", url, headers, payload, module)
+    response = client.request("GET", url)
     device_data = response.json()
     if "nms" in device_object:
         logging.info("NMS will be configured...")
@@ -467,22 +393,20 @@ def update_check(base_url, api_version, auth, module, device_id, device_object,
     return return_bool
 
 
-def update_device(base_url, api_version, auth, module, device_id, device_object):
+def update_device(client, api_version, device_id, device_object):
     """Function to update a device to kentik"""
     logging.info("Updating Device...")
-    url = f"{base_url}/device/{api_version}/device/{device_id}"
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}")
     device_object['id'] = device_id
-    payload = json.dumps({"device": device_object})
-    headers = auth
     device_data = ''
-    response = http_request_func("PUT", url, headers, payload, module)
+    response = client.request("PUT", url, payload={"device": device_object})
+    client.invalidate_catalog(client.grpc_url(f"/device/{api_version}/device"))
     device_data = response.json()
     return device_data["device"]["id"]
 
 
 def main():
     """The main function of the program"""
-    base_url = "https://grpc.api.kentik.com"
     argument_spec = dict(
         deviceName=dict(type="str", required=True),
         deviceDescription=dict(type="str", required=False, default="Added by Ansible"),
@@ -527,71 +451,58 @@ def main():
         deviceBgpFlowspec=dict(type="bool", required=False),
         nms=dict(type="dict", required=False),
         labels=dict(type="list", required=False, elements="str"),
-        email=dict(type="str", required=True),
-        token=dict(type="str", no_log=True, required=True),
-        region=dict(type="str", required=False, default="US", choices=["US", "EU"]),
         state=dict(type="str", default="present", choices=["present", "absent"]),
     )
+    argument_spec.update(client_argument_spec())
     module = AnsibleModule(
         argument_spec=argument_spec,
         supports_check_mode=True,
     )
     result = {"changed": False}
     state = module.params["state"]
-    auth = {
-        "X-CH-Auth-Email": module.params["email"],
-        "X-CH-Auth-API-Token": module.params["token"],
-        "Content-Type": "application/json",
-    }
-    if module.params["region"] == "EU":
-        base_url = "https://grpc.api.kentik.eu"
-        region = "EU"
-    else:
-        base_url = "https://grpc.api.kentik.com"
-        region = "US"
+    client = KentikClient(module)
     api_version = "v202308beta1"
     if module.params["labels"]:
         logging.info("Labels found")
-        labels = build_labels(base_url, api_version, auth, module)
+        labels = build_labels(client, api_version, module)
     else:
         logging.info("No Labels found")
         labels = False
     update_snmp_auth_bool = module.params["updateSnmpAuth"]
     result = {"changed": False}
-    # device_list = gather_devices(base_url, api_version, auth, module)
+    # device_list = gather_devices(client, api_version)
     # device_id = compare_device(device_list, module)
-    device_exists = check_device(auth, module, region)
+    device_exists = check_device(client, module)
     if state == "absent" and device_exists['exists']:
-        delete_device(base_url, api_version, auth, device_exists['id'], module)
+        delete_device(client, api_version, device_exists['id'])
         result["changed"] = True
     elif device_exists['exists'] and state == "present":
-        labels = compare_labels(base_url, api_version, auth, module, device_exists['id'], labels)
-        device_object = build_payload(base_url, auth, module)
-        needs_updated = update_check(base_url,
+        labels = compare_labels(client, api_version, device_exists['id'], labels)
+        device_object = build_payload(client, module)
+        needs_updated = update_check(client,
                                      api_version,
-                                     auth, module,
                                      device_exists['id'],
                                      device_object,
                                      update_snmp_auth_bool)
         if needs_updated:
-            update_device(base_url, api_version, auth, module, device_exists['id'], device_object)
+            update_device(client, api_version, device_exists['id'], device_object)
             result["changed"] = True
         else:
             result["changed"] = False
     elif not device_exists['exists'] and state == "present":
-        device_object = build_payload(base_url, auth, module)
-        device_id = create_device(base_url,
+        device_object = build_payload(client, module)
+        device_id = create_device(client,
                                   api_version,
-                                  auth,
-                                  module,
                                   device_object)
         result["changed"] = True
         result["device_id"] = device_id
     elif state == "absent" and not device_exists['exists']:
         result["changed"] = False
     if labels and len(labels) > 0 and state == "present":
-        update_device_labels(base_url, api_version, auth, module, device_id, labels)
+        update_device_labels(client, api_version, device_id, labels)
         result["changed"] = True
+    if client.timings.enabled:
+        result["timings"] = client.timings.report()
     module.exit_json(**result)
 
 
@@ -0,0 +1,467 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+ANSIBLE_METADATA = {"metadata_version": "1.0", "status": ["preview"], "supported_by": "certified"}
+
+DOCUMENTATION = r"""
+---
+module: kentik_devices
+short_description: This is a module that will perform idempotent operations on many kentik devices at once
+version_added: "1.3.0"
+description:
+- The module gathers the devices, sites, plans and labels from Kentik once and compares them with the desired device list.
+- The devices to create, update and delete are worked out locally, with the same rules as M(kentik.kentik_config.kentik_device).
+- The changes are then applied concurrently, up to I(kentikWorkers) at a time.
+options:
+    devices:
+        description: The desired devices, each takes the device options of M(kentik.kentik_config.kentik_device).
+        required: true
+        type: list
+        elements: dict
+        suboptions:
+            deviceName:
+                description: The name of the device.
+                required: true
+                type: str
+            deviceDescription:
+                description: The device description.
+                type: str
+                default: Added by Ansible
+            deviceSubtype:
+                description: The device subtype.
+                choices: [ router, host-nprobe-dns-www, aws-subnet, azure_subnet, cisco_asa, gcp-subnet, istio_beta, open_nms, paloalto, silverpeak ]
+                type: str
+                default: "router"
+            cdnAttr:
+                description: If this is a DNS server, you can contribute its queries to Kentik's CDN attribution database.
+                choices: [ none, y, n ]
+                type: str
+            deviceSampleRate:
+                description: The rate at which the device is sampling flows.
+                type: int
+                default: 1
+            planName:
+                description: The name of the plan to which this device is assigned, required when present.
+                type: str
+            siteName:
+                description: The name of the site to which this device is assigned, required when present.
+                type: str
+            sendingIps:
+                description: IP addresses from which the device is sending flow.
+                type: list
+                elements: str
+            minimizeSnmp:
+                description: Minimize the SNMP polling of the device.
+                type: bool
+            deviceSnmpIp:
+                description: IP address from which the device is listening on snmp.
+                type: str
+            deviceSnmpCommunity:
+                description: The SNMP community to use when polling the device.
+                type: str
+            updateSnmpAuth:
+                description: Update the SNMP Authentication.
+                type: bool
+                default: false
+            deviceSnmpV3Conf:
+                description:
+                - A dictionary with all snmpv3 attributes.
+                - Reference Kentik API Documentation for exact dictionary format.
+                type: dict
+            deviceBgpType:
+                description: BGP (device_bgp_type) - Device bgp type.
+                choices: [ none, device, other_device ]
+                type: str
+                default: none
+            deviceBgpNeighborIp:
+                description: Your IPv4 peering address.
+                type: str
+            deviceBgpNeighborIp6:
+                description: Your IPv6 peering address.
+                type: str
+            deviceBgpNeighborAsn:
+                description: The valid AS number (ASN) of the autonomous system that this device belongs to.
+                type: str
+            deviceBgpPassword:
+                description: Optional BGP MD5 password.
+                type: str
+            useBgpDeviceId:
+                description: The ID of the device whose BGP table should be shared with this device.
+                type: int
+            deviceBgpFlowspec:
+                description: Toggle BGP Flowspec Compatibility for device.
+                type: bool
+            nms:
+                description:
+                - A dictionary for adding NMS SNMP or streaming telemetry to a device.
+                - Reference Kentik API Documentation for exact dictionary format.
+                type: dict
+            labels:
+                description: Labels that get assigned to the device.
+                type: list
+                elements: str
+            state:
+                description: Whether to ensure the device should be present or if it should be removed.
+                type: str
+                choices: [present, absent]
+                default: present
+    purge:
+        description: Delete the devices in Kentik that are not in I(devices).
+        type: bool
+        default: false
+    kentikWorkers:
+        description: The maximum number of device changes to apply to Kentik concurrently.
+        type: int
+        default: 8
+extends_documentation_fragment:
+- kentik.kentik_config.kentik_client
+- kentik.kentik_config.kentik_client.catalog_cache
+author:
+- Ethan Angele (@kentikethan)
+"""
+
+EXAMPLES = r"""
+- name: Synchronize every router of the inventory in one task
+  kentik_devices:
+    devices: "{{ groups['routers'] | map('extract', hostvars, 'kentik_device') | list }}"
+    kentikWorkers: 8
+    email: someoneawesome@kentik.com
+    token: ewjhrtefngkrbgfsdgfh4o43r523
+    region: US
+  run_once: true
+  delegate_to: localhost
+
+- name: Create two devices and remove a third
+  kentik_devices:
+    devices:
+      - deviceName: edge_la1_001
+        planName: Free Flowpak Plan
+        siteName: Los Angeles
+        sendingIps: ["192.0.2.1"]
+        labels: ["edge"]
+      - deviceName: edge_la1_002
+        planName: Free Flowpak Plan
+        siteName: Los Angeles
+        sendingIps: ["192.0.2.2"]
+      - deviceName: edge_la1_003
+        state: absent
+    email: someoneawesome@kentik.com
+    token: ewjhrtefngkrbgfsdgfh4o43r523
+"""
+
+RETURN = r"""
+created:
+    description: The names of the devices created.
+    type: list
+    elements: str
+    returned: always
+    sample: ["edge_la1_001"]
+updated:
+    description: The names of the devices whose configuration or labels were updated.
+    type: list
+    elements: str
+    returned: always
+    sample: ["edge_la1_002"]
+deleted:
+    description: The names of the devices deleted.
+    type: list
+    elements: str
+    returned: always
+    sample: ["edge_la1_003"]
+unchanged:
+    description: The number of devices that already matched.
+    type: int
+    returned: always
+    sample: 120
+device_ids:
+    description: The ids of the devices that are present, keyed by device name.
+    type: dict
+    returned: always
+    sample: {"edge_la1_001": "101", "edge_la1_002": "102"}
+timings:
+    description: The module run time, the seconds spent fetching, planning and applying, and every http request.
+    type: dict
+    returned: when collectTimings is enabled
+    sample: {"seconds": 4.2, "phases": {"fetch": {"count": 1, "seconds": 0.8}},
+             "endpoints": {"GET /device/v202308beta1/device": {"count": 1, "seconds": 0.6, "max_seconds": 0.6,
+                           "bytes_out": 0, "bytes_in": 2097152, "retries": 0, "throttle_seconds": 0}},
+             "requests": []}
+"""
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_client import (
+    KentikClient, client_argument_spec, fail_once, run_concurrently)
+import functools
+import logging
+
+# Device options that steer the module and are not part of the device payload.
+CONTROL_OPTIONS = ("planName", "siteName", "labels", "state", "updateSnmpAuth")
+
+
+def gather_catalog(client, url, key, name_key):
+    """Gather a catalog listing as a dictionary of ids keyed by name"""
+    catalog = {}
+    for item in client.catalog(url)[key]:
+        catalog[item[name_key]] = item["id"]
+    return catalog
+
+
+def gather_devices(client, api_version):
+    """Gather every existing device, keyed by device name"""
+    url = client.grpc_url(f"/device/{api_version}/device")
+    devices = {}
+    for device in client.catalog(url)["devices"]:
+        devices[device["deviceName"]] = device
+    return devices
+
+
+def build_payload(entry, site_id, plan_id):
+    """Function to build the device object payload of one desired device"""
+    payload = {key: value for key, value in entry.items()
+               if key not in CONTROL_OPTIONS and value is not None}
+    payload["siteId"] = int(site_id)
+    payload["planId"] = int(plan_id)
+    if "nms" in payload:
+        if "port" in payload["nms"]["snmp"]:
+            payload["nms"]["snmp"]["port"] = int(payload["nms"]["snmp"]["port"])
+    return payload
+
+
+def needs_update(device_data, device_object, update_bool):
+    """Function to check whether a device needs to be updated, with the rules of kentik_device"""
+    if "nms" in device_object and "port" not in device_object["nms"]["snmp"] and "nms" in device_data:
+        # The configured nms leaves the port to kentik, so the returned port is not compared.
+        snmp = {key: value for key, value in device_data["nms"]["snmp"].items() if key != "port"}
+        device_data = {**device_data, "nms": {**device_data["nms"], "snmp": snmp}}
+    if int(device_data["site"]["id"]) != int(device_object["siteId"]):
+        logging.info("Site of %s does not match...updating...", device_object["deviceName"])
+        return True
+    if int(device_data["plan"]["id"]) != int(device_object["planId"]):
+        logging.info("Plan IDs of %s don't match...updating", device_object["deviceName"])
+        return True
+    if update_bool:
+        return True
+    for key, value in device_object.items():
+        if key in ("siteId", "planId", "deviceSnmpCommunity"):
+            continue
+        if key not in device_data:
+            logging.info("Configured %s: %s is not yet configured.", key, value)
+            return True
+        if str(device_data[key]) != str(value):
+            logging.info("Configured %s: %s does not match returned %s: %s", key, value, key, device_data[key])
+            return True
+    return False
+
+
+def labels_differ(device_data, label_ids):
+    """Function to compare labels on a device to determine if they need updated"""
+    current = sorted(str(label["id"]) for label in device_data.get("labels") or [])
+    return current != sorted(str(label_id) for label_id in label_ids)
+
+
+def plan_changes(module, devices, sites, plans, labels):
+    """Work out the creates, updates and deletes that bring kentik in line with the desired devices.
+
+    Returns the changes, the names of the devices left unchanged and the names of every listed device.
+    """
+    changes = []
+    unchanged = []
+    errors = []
+    desired_names = set()
+    for entry in module.params["devices"]:
+        name = entry["deviceName"]
+        if name in desired_names:
+            errors.append(f"Device {name} is listed more than once.")
+            continue
+        desired_names.add(name)
+        existing = devices.get(name)
+        if entry["state"] == "absent":
+            if existing is not None:
+                changes.append({"action": "delete", "name": name, "id": existing["id"]})
+            continue
+        if entry["siteName"] not in sites:
+            errors.append(f"Site {entry['siteName']} of device {name} does not exist.")
+            continue
+        if entry["planName"] not in plans:
+            errors.append(f"Plan {entry['planName']} of device {name} does not exist.")
+            continue
+        missing_labels = [label for label in entry["labels"] or [] if label and label not in labels]
+        if missing_labels:
+            errors.append(f"Labels {', '.join(missing_labels)} of device {name} do not exist.")
+            continue
+        device_object = build_payload(entry, sites[entry["siteName"]], plans[entry["planName"]])
+        label_ids = [labels[label] for label in entry["labels"] or [] if label]
+        if existing is None:
+            changes.append({"action": "create", "name": name, "payload": device_object, "labels": label_ids})
+            continue
+        update = needs_update(existing, device_object, entry["updateSnmpAuth"])
+        # Labels are only managed for devices that list them, like kentik_device does.
+        relabel = bool(label_ids) and labels_differ(existing, label_ids)
+        if update or relabel:
+            changes.append({"action": "update", "name": name, "id": existing["id"],
+                            "payload": device_object if update else None,
+                            "labels": label_ids if relabel else None})
+        else:
+            unchanged.append(name)
+    if module.params["purge"]:
+        for name, existing in devices.items():
+            if name not in desired_names:
+                changes.append({"action": "delete", "name": name, "id": existing["id"]})
+    if errors:
+        module.fail_json(msg=" ".join(errors))
+    return changes, unchanged, desired_names
+
+
+def create_device(client, api_version, device_object):
+    """Function to add a device to kentik"""
+    logging.info("Creating Device %s...", device_object["deviceName"])
+    url = client.grpc_url(f"/device/{api_version}/device")
+    response = client.request("POST", url, payload={"device": device_object})
+    return response.json()["device"]["id"]
+
+
+def update_device(client, api_version, device_id, device_object):
+    """Function to update a device to kentik"""
+    logging.info("Updating Device %s...", device_object["deviceName"])
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}")
+    response = client.request("PUT", url, payload={"device": {**device_object, "id": device_id}})
+    return response.json()["device"]["id"]
+
+
+def update_device_labels(client, api_version, device_id, labels):
+    """Function to add or update device labels"""
+    logging.info("Updating Device Labels...")
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}/labels")
+    labels_list = [{"id": int(label)} for label in labels]
+    client.request("PUT", url, payload={"id": device_id, "labels": labels_list})
+
+
+def delete_device(client, api_version, device_id):
+    """Function to delete a device from Kentik"""
+    logging.info("Archiving Device...")
+    url = client.grpc_url(f"/device/{api_version}/device/{device_id}")
+    client.request("DELETE", url)
+
+
+def apply_change(client, api_version, change):
+    """Apply one planned change and return the id of the device"""
+    device_id = change.get("id")
+    if change["action"] == "delete":
+        delete_device(client, api_version, device_id)
+        return device_id
+    if change["action"] == "create":
+        device_id = create_device(client, api_version, change["payload"])
+    elif change["payload"] is not None:
+        update_device(client, api_version, device_id, change["payload"])
+    if change["labels"]:
+        update_device_labels(client, api_version, device_id, change["labels"])
+    return device_id
+
+
+def main():
+    """The main function of the program"""
+    device_options = dict(
+        deviceName=dict(type="str", required=True),
+        deviceDescription=dict(type="str", required=False, default="Added by Ansible"),
+        deviceSubtype=dict(
+            type="str",
+            required=False,
+            default="router",
+            choices=[
+                "router",
+                "host-nprobe-dns-www",
+                "aws-subnet",
+                "azure_subnet",
+                "cisco_asa",
+                "gcp-subnet",
+                "istio_beta",
+                "open_nms",
+                "paloalto",
+                "silverpeak",
+            ],
+        ),
+        cdnAttr=dict(type="str", required=False, choices=["none", "y", "n"]),
+        deviceSampleRate=dict(type="int", required=False, default=1),
+        planName=dict(type="str", required=False),
+        siteName=dict(type="str", required=False),
+        sendingIps=dict(type="list", required=False, elements="str"),
+        minimizeSnmp=dict(type="bool", required=False),
+        deviceSnmpIp=dict(type="str", required=False),
+        deviceSnmpCommunity=dict(type="str", required=False),
+        updateSnmpAuth=dict(type="bool", required=False, default=False),
+        deviceSnmpV3Conf=dict(type="dict", required=False),
+        deviceBgpType=dict(
+            type="str",
+            required=False,
+            choices=["none", "device", "other_device"],
+            default="none",
+        ),
+        deviceBgpNeighborIp=dict(type="str", required=False),
+        deviceBgpNeighborIp6=dict(type="str", required=False),
+        deviceBgpNeighborAsn=dict(type="str", required=False),
+        deviceBgpPassword=dict(type="str", required=False, no_log=True),
+        useBgpDeviceId=dict(type="int", required=False),
+        deviceBgpFlowspec=dict(type="bool", required=False),
+        nms=dict(type="dict", required=False),
+        labels=dict(type="list", required=False, elements="str"),
+        state=dict(type="str", default="present", choices=["present", "absent"]),
+    )
+    argument_spec = dict(
+        devices=dict(type="list", required=True, elements="dict", options=device_options,
+                     required_if=[("state", "present", ("planName", "siteName"))]),
+        purge=dict(type="bool", required=False, default=False),
+        kentikWorkers=dict(type="int", required=False, default=8),
+    )
+    argument_spec.update(client_argument_spec())
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+    )
+    # Changes are applied on worker threads, any of which may fail the module.
+    fail_once(module)
+    result = {"changed": False}
+    client = KentikClient(module, pool_size=module.params["kentikWorkers"] + 1)
+    timings = client.timings
+    api_version = "v202308beta1"
+    # Every catalog is fetched once for the whole device list.
+    with timings.phase("fetch"):
+        labels = gather_catalog(client, client.grpc_url("/label/v202210/labels"), "labels", "name")
+        sites = gather_catalog(client, client.grpc_url("/site/v202211/sites"), "sites", "title")
+        plans = gather_catalog(client, client.api_url("/plans"), "plans", "name")
+        devices = gather_devices(client, api_version)
+    with timings.phase("build"):
+        changes, unchanged, desired_names = plan_changes(module, devices, sites, plans, labels)
+    logging.info("%s device changes to apply, %s devices unchanged", len(changes), len(unchanged))
+    # Only the listed devices are reported, not every device of the account.
+    device_ids = {name: devices[name]["id"] for name in desired_names if name in devices}
+    if changes and not module.check_mode:
+        calls = [functools.partial(apply_change, client, api_version, change) for change in changes]
+        try:
+            with timings.phase("upload"):
+                applied = run_concurrently(module, module.params["kentikWorkers"], calls)
+        finally:
+            # Even a failed run may have changed some devices before it stopped.
+            client.invalidate_catalog(client.grpc_url(f"/device/{api_version}/device"))
+        for change, device_id in zip(changes, applied):
+            device_ids[change["name"]] = device_id
+    for change in changes:
+        if change["action"] == "delete":
+            device_ids.pop(change["name"], None)
+    result["changed"] = bool(changes)
+    result["created"] = [change["name"] for change in changes if change["action"] == "create"]
+    result["updated"] = [change["name"] for change in changes if change["action"] == "update"]
+    result["deleted"] = [change["name"] for change in changes if change["action"] == "delete"]
+    result["unchanged"] = len(unchanged)
+    result["device_ids"] = device_ids
+    if timings.enabled:
+        result["timings"] = timings.report()
+    module.exit_json(**result)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,26 +21,14 @@ options:
         description: The hexidecimal color code to be applied to the label. Default is a gray color.
         type: str
         required: true
-    region:
-        description: The reqion that your Kentik portal is located in.
-        type: str
-        default: US
-        choices:
-        - US
-        - EU
     state:
         description: Whether to ensure the device should be present or if it should be removed.
         type: str
         choices: [present, absent]
         default: present
-    token:
-        description: The Kentik API Token used to authenticate.
-        type: str
-        required: true
-    email:
-        description: The Kentik API Email used to authenticate.
-        type: str
-        required: true
+extends_documentation_fragment:
+- kentik.kentik_config.kentik_client
+- kentik.kentik_config.kentik_client.catalog_cache
 author:
 - Ethan Angele (@kentikethan)
 """
@@ -67,6 +55,16 @@ EXAMPLES = r"""
 
 RETURN = r"""
 # These are examples of possible return values, and in general should use other names for return values.
+timings:
+    description: The module run time and every http request with its latency, body bytes, retries and time
+                 waited on the rate limit, also summed per endpoint.
+    type: dict
+    returned: when collectTimings is enabled
+    sample: {"seconds": 0.9, "phases": {},
+             "endpoints": {"GET /label/v202210/labels": {"count": 1, "seconds": 0.31, "max_seconds": 0.31,
+                           "bytes_out": 0, "bytes_in": 20480, "retries": 0, "throttle_seconds": 0}},
+             "requests": [{"method": "GET", "endpoint": "/label/v202210/labels", "status": 200, "seconds": 0.31,
+                           "bytes_out": 0, "bytes_in": 20480, "retries": 0, "throttle_seconds": 0}]}
 original_message:
     description: The original name param that was passed in.
     type: str
@@ -80,41 +78,20 @@ message:
 """
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_text
-try:
-    import requests
-except ImportError:
-    HAS_ANOTHER_LIBRARY = False
-import json
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_client import (
+    KentikClient, client_argument_spec, payload_params)
 import logging
 
 
 def build_payload(module):
     """Build the request payload"""
-    payload = module.params
-    del payload["email"]
-    del payload["token"]
-    del [payload["state"]]
-    del [payload["region"]]
-    return payload
+    return payload_params(module, exclude=("state",))
 
 
-def gather_labels(base_url, api_version, auth, module):
+def gather_labels(client, api_version):
     """Gather the current list of labels"""
-    url = f"{base_url}/label/{api_version}/labels"
-    payload = {}
-    headers = auth
-    label_data = {}
-    try:
-        response = requests.request(
-            "GET", url, headers=headers, data=payload, timeout=30
-        )
-        if response.status_code == 200:
-            label_data = response.json()
-        else:
-            module.fail_json(msg=f"gatherLabels: {response.text}")
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
+    url = client.grpc_url(f"/label/{api_version}/labels")
+    label_data = client.catalog(url)
     label_dict = {}
     for label in label_data["labels"]:
         label_dict[label["name"]] = label["id"]
@@ -133,46 +110,23 @@ def compare_label(label_list, module):
     return function_return
 
 
-def delete_label(base_url, api_version, auth, module, label_id):
+def delete_label(client, api_version, label_id):
     """Deletes the site"""
     logging.info("Deleting Label...")
-    url = f"{base_url}/label/{api_version}/labels/{label_id}"
-    payload = {}
-    headers = auth
-    function_return = ""
-    try:
-        response = requests.request(
-            "DELETE", url, headers=headers, data=payload, timeout=30
-        )
-        if response.status_code == 200:
-            function_return = "OK"
-        else:
-            module.fail_json(msg=response.text)
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
-    return function_return
+    url = client.grpc_url(f"/label/{api_version}/labels/{label_id}")
+    client.request("DELETE", url)
+    client.invalidate_catalog(client.grpc_url(f"/label/{api_version}/labels"))
+    return "OK"
 
 
-def create_label(base_url, api_version, auth, module, site_object):
+def create_label(client, api_version, site_object):
     """Creates a site"""
     logging.info("Creating Label...")
-    url = f"{base_url}/label/{api_version}/labels"
-
-    payload = json.dumps({"label": site_object})
-    headers = auth
-    function_return = ''
-    try:
-        response = requests.request(
-            "POST", url, headers=headers, data=payload, timeout=30
-        )
-        label_data = response.json()
-        if response.status_code == 200:
-            function_return = label_data["label"]["id"]
-        else:
-            module.fail_json(msg=response.text)
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
-    return function_return
+    url = client.grpc_url(f"/label/{api_version}/labels")
+    response = client.request("POST", url, payload={"label": site_object})
+    client.invalidate_catalog(url)
+    label_data = response.json()
+    return label_data["label"]["id"]
 
 
 def main():
@@ -180,11 +134,9 @@ def main():
     argument_spec = dict(
         name=dict(type="str", required=True),
         color=dict(type="str", required=True),
-        email=dict(type="str", required=True),
-        token=dict(type="str", no_log=True, required=True),
-        region=dict(type="str", default="US", choices=["US", "EU"]),
         state=dict(default="present", choices=["present", "absent"]),
     )
+    argument_spec.update(client_argument_spec())
     module = AnsibleModule(
         argument_spec=argument_spec,
         supports_check_mode=True,
@@ -192,20 +144,12 @@ def main():
     result = {"changed": False}
     warnings = list()
     state = module.params["state"]
-    auth = {
-        "X-CH-Auth-Email": module.params["email"],
-        "X-CH-Auth-API-Token": module.params["token"],
-        "Content-Type": "application/json",
-    }
-    if module.params["region"] == "EU":
-        base_url = "https://grpc.api.kentik.eu"
-    else:
-        base_url = "https://grpc.api.kentik.com"
+    client = KentikClient(module)
     api_version = "v202210"
     site_object = build_payload(module)
     result = {"changed": False}
     warnings = list()
-    label_list = gather_labels(base_url, api_version, auth, module)
+    label_list = gather_labels(client, api_version)
     label_exists = compare_label(label_list, module)
 
     if label_exists:
@@ -213,15 +157,17 @@ def main():
             result["changed"] = False
             result["label_id"] = label_exists
         elif state == "absent":
-            label_id = delete_label(base_url, api_version, auth, module, label_exists)
+            label_id = delete_label(client, api_version, label_exists)
             result["changed"] = True
     else:
         if state == "present":
-            label_id = create_label(base_url, api_version, auth, module, site_object)
+            label_id = create_label(client, api_version, site_object)
             result["changed"] = True
             result["label_id"] = label_id
         elif state == "absent":
             result["changed"] = False
+    if client.timings.enabled:
+        result["timings"] = client.timings.report()
     module.exit_json(**result)
 
 
@@ -65,24 +65,137 @@ options:
         description: Custom Field to add as a custom dimension.
         type: str
     activeOnly:
-        description: Only add prefixes that are active in Netbox.
+        description:
+        - Only add prefixes that are active in Netbox.
+        - With the GraphQL api the status filter is only left to Netbox when it accepts it in list form,
+          otherwise the status of every prefix is checked after it was transferred.
         type: bool
         default: true
-    region:
-        description: The reqion that your Kentik portal is located in.
+    netboxFilters:
+        description:
+        - Additional Netbox prefix filters, their form depends on I(netboxApi).
+        - With the REST api they are passed straight through as query parameters, for example
+          C(site), C(tenant), C(role) or C(vrf_id), lists match any of the values.
+        - With the GraphQL api they are passed as the C(filters) input of the prefix_list query instead,
+          so they must follow the PrefixFilter input type of the Netbox version in use.
+        - The I(prefixCache) always uses the REST api, so it always takes REST query parameters.
+        type: dict
+    netboxApi:
+        description:
+        - The Netbox api used to collect the prefixes.
+        - C(graphql) requests only the fields used by the module and requires Netbox 4.0 or later.
+          The site of a prefix is read from its scope on Netbox 4.2 and later, and directly before.
+        - The prefix cache always uses the REST api, and only REST responses are parsed incrementally.
         type: str
-        default: US
+        default: rest
         choices:
-            - US
-            - EU
-    token:
-        description: The Kentik API Token used to authenticate.
-        type: str
-        required: true
-    email:
-        description: The Kentik API Email used to authenticate.
+            - rest
+            - graphql
+    netboxTrimFields:
+        description:
+        - Ask Netbox to only return the prefix fields used by the module.
+        - Requires Netbox 4.0 or later.
+        type: bool
+        default: false
+    netboxPageSize:
+        description:
+        - The number of prefixes to request from Netbox per page.
+        - Netbox will cap this at its configured MAX_PAGE_SIZE.
+        - The GraphQL api returns no total, so a page shorter than this is taken as the last one.
+          Keep it at or under the MAX_PAGE_SIZE of Netbox when using GraphQL.
+        type: int
+        default: 1000
+    netboxWorkers:
+        description: The maximum number of Netbox pages to fetch concurrently.
+        type: int
+        default: 4
+    packPopulators:
+        description:
+        - Pack every prefix sharing a value into a single populator criteria address list.
+        - Shrinks the batch payload instead of sending one criteria per prefix.
+        type: bool
+        default: false
+    populatorAddrLimit:
+        description: The maximum number of addresses in one criteria when packPopulators is enabled.
+        type: int
+        default: 1000
+    batchPartBytes:
+        description:
+        - Split each custom dimension upload into parts of at most this many serialized bytes.
+        - The parts share one batch guid and only the last part completes the batch.
+        - Set to 0 to upload each dimension in a single request.
+        type: int
+        default: 0
+    gzipBodies:
+        description:
+        - Compress the populator batch and site update request bodies with gzip.
+        - Only bodies of at least I(gzipThreshold) bytes are compressed.
+        type: bool
+        default: false
+    gzipThreshold:
+        description: The minimum size in bytes of a request body before it is compressed.
+        type: int
+        default: 65536
+    batchTimeout:
+        description: The number of seconds to wait for a batch to be applied before failing.
+        type: int
+        default: 300
+    batchPollInterval:
+        description:
+        - The number of seconds to wait before the second status check of a batch.
+        - The wait doubles after every check that finds the batch still running.
+        type: float
+        default: 1
+    populatorSync:
+        description:
+        - How the custom dimension populators are synchronized with Kentik.
+        - C(replace) sends every populator and replaces the whole dimension.
+        - C(diff) compares the addresses and every other criteria of the existing populators and only sends
+          the values that changed or were removed, including every value of a dimension left empty in Netbox.
         type: str
-        required: true
+        default: replace
+        choices:
+            - replace
+            - diff
+    checkpointFile:
+        description:
+        - Path to a file recording a hash of every payload successfully applied to Kentik.
+        - On later runs a custom dimension direction, or the site merge, whose payload hash
+          is unchanged is skipped without contacting Kentik.
+        - Changes made directly in Kentik are not detected while the Netbox data is unchanged,
+          run once with I(ignoreCheckpoints) to repair them.
+        - Nothing is recorded in check mode, and the site merge is not recorded while a Netbox site
+          is missing from Kentik, so its prefixes are merged once the site is created.
+        type: path
+    ignoreCheckpoints:
+        description:
+        - Upload every payload even when its hash matches the I(checkpointFile).
+        - The hashes of the payloads applied are still recorded for the following runs.
+        type: bool
+        default: false
+    kentikWorkers:
+        description: The maximum number of enabled options, and of site updates, to synchronize with Kentik concurrently.
+        type: int
+        default: 4
+    prefixCache:
+        description:
+        - Path to a local SQLite database used to cache the Netbox prefixes between runs.
+        - When set, only prefixes changed since the last run are pulled from Netbox and
+          the custom dimensions are built from the cache.
+        - Prefixes deleted in Netbox are found by listing the ids of every prefix, which is much
+          lighter than pulling the prefixes again.
+        type: path
+    netboxStreaming:
+        description:
+        - Parse the Netbox responses incrementally instead of loading each page body into memory.
+        - Only the raw json of the pages is kept out of memory. Every parsed prefix is still collected,
+          in a compact table or in the I(prefixCache), before the prefixes are grouped for the enabled options.
+        - Requires the ijson python library.
+        type: bool
+        default: false
+
+extends_documentation_fragment:
+- kentik.kentik_config.kentik_client
 
 author:
 - Ethan Angele (@kentikethan)
@@ -125,6 +238,28 @@ EXAMPLES = r"""
 
 RETURN = r"""
 # These are examples of possible return values, and in general should use other names for return values.
+batch_timings:
+    description: Time taken for each batch guid to be applied by Kentik, keyed by guid.
+    type: dict
+    returned: always
+    sample: {"f3b5...": {"name": "tenant", "direction": "src", "seconds": 3.52, "polls": 3}}
+compression:
+    description: The request bodies compressed with gzip and the bytes saved by compressing them.
+    type: dict
+    returned: always
+    sample: {"bodies": 12, "bytes_in": 10485760, "bytes_sent": 524288, "bytes_saved": 9961472}
+timings:
+    description:
+    - The module run time, the seconds spent in each phase and every http request with its latency,
+      body bytes, retries and time waited on the rate limit, also summed per endpoint.
+    - Phases run on several threads at once add up their seconds.
+    type: dict
+    returned: when collectTimings is enabled
+    sample: {"seconds": 12.4, "phases": {"fetch": {"count": 1, "seconds": 4.1}},
+             "endpoints": {"GET /api/ipam/prefixes/": {"count": 10, "seconds": 3.9, "max_seconds": 0.6,
+                           "bytes_out": 0, "bytes_in": 5242880, "retries": 0, "throttle_seconds": 0}},
+             "requests": [{"method": "GET", "endpoint": "/api/ipam/prefixes/", "status": 200, "seconds": 0.41,
+                           "bytes_out": 0, "bytes_in": 524288, "retries": 0, "throttle_seconds": 0}]}
 original_message:
     description: The original name param that was passed in.
     type: str
@@ -137,26 +272,140 @@ message:
     sample: 'goodbye'
 """
 
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 from ansible.module_utils._text import to_text
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_client import (
+    KentikClient, SpooledBody, client_argument_spec, fail_once, run_concurrently)
+from array import array
+from collections import deque
+from collections.abc import Hashable
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import ipaddress
+import itertools
+import os
+import sqlite3
+import threading
 import time
+import traceback
+import zlib
 try:
     import requests
 except ImportError:
     HAS_ANOTHER_LIBRARY = False
+try:
+    import ijson
+except ImportError:
+    HAS_IJSON = False
+    IJSON_IMPORT_ERROR = traceback.format_exc()
+else:
+    HAS_IJSON = True
+    IJSON_IMPORT_ERROR = None
 import json
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# The prefix fields requested from Netbox when trimming the responses. Netbox 4.2 replaced
+# the site of a prefix with its scope, each version ignores the fields it does not have.
+NETBOX_PREFIX_FIELDS = ("id", "prefix", "site", "scope", "scope_type", "tenant", "vlan", "role",
+                        "description", "custom_fields", "last_updated")
+# GraphQL filter keeping only the active prefixes. Netbox versions with lookup based filters reject
+# this list form, the module then falls back to checking the status of each prefix itself.
+NETBOX_GRAPHQL_ACTIVE_FILTER = {"status": ["active"]}
+# The selections of the site of a prefix, through its scope since Netbox 4.2 and directly before.
+NETBOX_GRAPHQL_SITE_FIELDS = ("scope { ... on SiteType { name } }", "site { name }")
+# GraphQL query selecting only the prefix fields used by the module, completed with one of the
+# site selections. Custom fields are a single JSON value in the Netbox schema so they cannot be narrowed further.
+NETBOX_GRAPHQL_QUERY = """
+query ($pagination: OffsetPaginationInput, $filters: PrefixFilter) {
+  prefix_list(pagination: $pagination, filters: $filters) {
+    prefix
+    status
+    description
+    custom_fields
+    %s
+    tenant { name }
+    vlan { name }
+    role { name }
+  }
+}
+"""
+# The address classifications of a kentik site.
+SITE_CLASSIFICATIONS = ("infrastructureNetworks", "userAccessNetworks", "otherNetworks")
+# Upper bound for the backoff between batch status checks, in seconds.
+BATCH_POLL_MAX_INTERVAL = 30
+# Encoder producing the canonical form of a payload for checkpoint hashes.
+CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+# Fields of an existing populator that are bookkeeping rather than criteria matching the flows.
+POPULATOR_METADATA = ("id", "dimension_id", "company_id", "value", "user",
+                      "created_date", "updated_date", "addr_count", "mac_count")
+# Batch bodies are encoded and spooled in chunks of roughly this many bytes.
+BATCH_BODY_CHUNK_BYTES = 64 * 1024
+
 
-def build_kentik_auth(module):
-    '''Build the kentik auth dictionary for headers'''
-    kentik_auth = {
-        "X-CH-Auth-Email": module.params["email"],
-        "X-CH-Auth-API-Token": module.params["token"],
-        "Content-Type": "application/json",
-    }
-    return kentik_auth
+class BodyCompressor:
+    '''Gzip compresses request bodies over a size threshold and counts the bytes saved.'''
+
+    def __init__(self, module):
+        self.enabled = module.params["gzipBodies"]
+        self.threshold = module.params["gzipThreshold"]
+        self.lock = threading.Lock()
+        self.bodies = 0
+        self.bytes_in = 0
+        self.bytes_sent = 0
+
+    def prepare(self, headers, body):
+        '''Return the headers and the body to send, the body is either bytes or an iterator of bytes.'''
+        if not self.enabled:
+            return headers, body
+        if isinstance(body, bytes):
+            if len(body) < self.threshold:
+                return headers, body
+            # A body already in memory stays bytes so it can be sent again when throttled.
+            return {**headers, "Content-Encoding": "gzip"}, b"".join(self.compress([body]))
+        # Read ahead until the threshold is reached, a body that ends first is sent as is.
+        chunks = body
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.threshold:
+                break
+        else:
+            return headers, b"".join(head)
+        return {**headers, "Content-Encoding": "gzip"}, self.compress(itertools.chain(head, chunks))
+
+    def compress(self, chunks):
+        '''Yield the gzip stream of the chunks, counting the bytes as they are sent.'''
+        compressor = zlib.compressobj(wbits=31)
+        bytes_in = 0
+        bytes_sent = 0
+        for chunk in chunks:
+            bytes_in += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                bytes_sent += len(data)
+                yield data
+        data = compressor.flush()
+        bytes_sent += len(data)
+        yield data
+        with self.lock:
+            self.bodies += 1
+            self.bytes_in += bytes_in
+            self.bytes_sent += bytes_sent
+
+    def report(self):
+        '''Return the compression totals for the module result.'''
+        return {"bodies": self.bodies,
+                "bytes_in": self.bytes_in,
+                "bytes_sent": self.bytes_sent,
+                "bytes_saved": self.bytes_in - self.bytes_sent}
+
+
+class NetboxGraphQLError(Exception):
+    '''Raised when the Netbox GraphQL api answers with errors'''
 
 
 def build_netbox_auth(module):
@@ -168,42 +417,554 @@ def build_netbox_auth(module):
     return netbox_auth
 
 
-def collect_prefixes(module, headers):
-    """ Collect the prefixes from Netbox """
-    # Could add streaming support potentially?
+def prefix_site(item):
+    """ Return the site name of a Netbox prefix, None when it is not assigned to a site """
+    if item.get("site") is not None:
+        return item["site"]["name"]
+    # Netbox 4.2 and later assign the prefix to a site, region, site group or location through its scope.
+    # The GraphQL query only selects the name of site scopes, so its items carry no scope_type.
+    if item.get("scope") is not None and item.get("scope_type", "dcim.site") == "dcim.site":
+        return item["scope"].get("name")
+    return None
+
+
+def normalize_prefix(item, custom_field_name):
+    """ Reduce a Netbox prefix object down to the fields used by the module """
+    site = prefix_site(item)
+    prefix = {"prefix": item["prefix"],
+              **({"site": site}
+              if site is not None else {}),
+              **({"tenant": item["tenant"]["name"]}
+              if item["tenant"] is not None else {}),
+              **({"vlan": item["vlan"]["name"]}
+              if item["vlan"] is not None else {}),
+              **({"role": item["role"]["name"]}
+              if item["role"] is not None else {}),
+              **({custom_field_name:
+                 item["custom_fields"][custom_field_name]}
+              if custom_field_name in item["custom_fields"]
+              else {}),
+              **({"description": item["description"]}
+              if item["description"] is not None else {})
+              }
+    return prefix
+
+
+def parse_prefix_page(stream, normalize):
+    """ Incrementally parse a Netbox page, returning the count, page size and normalized prefixes """
+    count = None
+    prefixes = []
+    builder = None
+    # Only one prefix object is ever fully built at a time, the raw page body is never held.
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if prefix == "count":
+            count = value
+        elif prefix == "results.item":
+            if event == "start_map":
+                builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            if event == "end_map":
+                prefixes.append(normalize(builder.value))
+                builder = None
+        elif builder is not None:
+            builder.event(event, value)
+    return count, len(prefixes), prefixes
+
+
+def fetch_netbox_page(url, headers, timings, normalize, streaming, params, limit, offset):
+    """ Fetch a single page of prefixes from Netbox """
+    logging.info("Fetching Netbox prefixes with limit %s and offset %s", limit, offset)
+    started = time.monotonic()
+    response = requests.get(f"{url}/api/ipam/prefixes/",
+                            headers=headers,
+                            params={**params, "limit": limit, "offset": offset},
+                            timeout=30,
+                            stream=streaming)
+    response.raise_for_status()
+    if streaming:
+        response.raw.decode_content = True
+        page = parse_prefix_page(response.raw, normalize)
+        # The body is parsed as it arrives, so the parsing is part of the request time here.
+        timings.record_request("GET", f"{url}/api/ipam/prefixes/", response.status_code, time.monotonic() - started,
+                               0, response.raw.tell())
+        return page
+    data = response.json()
+    timings.record_request("GET", f"{url}/api/ipam/prefixes/", response.status_code, time.monotonic() - started,
+                           0, len(response.content))
+    return data["count"], len(data["results"]), [normalize(item) for item in data["results"]]
+
+
+def build_netbox_filters(module):
+    """ Build the query parameters that Netbox filters and trims the prefixes with """
+    filters = dict(module.params["netboxFilters"] or {})
+    if module.params["activeOnly"]:
+        filters["status"] = "active"
+    if module.params["netboxTrimFields"]:
+        filters["fields"] = ",".join(NETBOX_PREFIX_FIELDS)
+    return filters
+
+
+def build_page_fetcher(module, headers, timings, params=None, normalize=None):
+    """ Bind the Netbox connection details so only the limit and offset are left to pass """
+    if normalize is None:
+        normalize = functools.partial(normalize_prefix,
+                                      custom_field_name=module.params["customFieldName"])
+    return functools.partial(fetch_netbox_page,
+                             module.params["netboxUrl"].rstrip("/"),
+                             headers,
+                             timings,
+                             normalize,
+                             module.params["netboxStreaming"],
+                             {**build_netbox_filters(module), **(params or {})})
+
+
+def fetch_netbox_graphql_page(url, headers, timings, query, filters, active_only, normalize, limit, offset):
+    """ Fetch a single page of prefixes from the Netbox GraphQL api """
+    logging.info("Fetching Netbox prefixes over GraphQL with limit %s and offset %s", limit, offset)
+    variables = {"pagination": {"limit": limit, "offset": offset}}
+    if filters:
+        variables["filters"] = filters
+    body = json.dumps({"query": query, "variables": variables})
+    started = time.monotonic()
+    response = requests.post(f"{url}/graphql/",
+                             headers=headers,
+                             data=body,
+                             timeout=30)
+    response.raise_for_status()
+    data = response.json()
+    timings.record_request("POST", f"{url}/graphql/", response.status_code, time.monotonic() - started,
+                           len(body), len(response.content))
+    if data.get("errors"):
+        raise NetboxGraphQLError("; ".join(error["message"] for error in data["errors"]))
     prefixes = []
-    url = module.params["netboxUrl"]
+    for item in data["data"]["prefix_list"]:
+        # The status filter syntax differs between Netbox versions, so it is checked here as well.
+        if active_only and str(item["status"]).lower().replace("status_", "") != "active":
+            continue
+        prefixes.append(normalize(item))
+    # GraphQL lists carry no total count, the pages are followed until one comes back short.
+    return None, len(data["data"]["prefix_list"]), prefixes
+
+
+def build_graphql_query(module, headers, timings):
+    """ Return the GraphQL prefix query selecting the site the way this Netbox version does """
+    # A single prefix is enough to tell whether this Netbox version knows the site selection.
+    errors = []
+    for site_field in NETBOX_GRAPHQL_SITE_FIELDS:
+        query = NETBOX_GRAPHQL_QUERY % site_field
+        try:
+            fetch_netbox_graphql_page(module.params["netboxUrl"].rstrip("/"), headers, timings,
+                                      query, {}, False, lambda item: item, 1, 0)
+        except NetboxGraphQLError as exc:
+            logging.info("Netbox rejected the GraphQL prefix query selecting %s: %s", site_field, exc)
+            errors.append(to_text(exc))
+            continue
+        except (ConnectionError, requests.exceptions.RequestException) as exc:
+            module.fail_json(msg=to_text(exc))
+        return query
+    module.fail_json(msg=f"Netbox rejected the GraphQL prefix query: {'; '.join(errors)}")
+
+
+def build_graphql_filters(module, headers, timings, query):
+    """ Build the GraphQL filters input, with the active status pushed down when Netbox accepts it """
+    filters = dict(module.params["netboxFilters"] or {})
+    if not module.params["activeOnly"] or "status" in filters:
+        return filters
+    active = {**filters, **NETBOX_GRAPHQL_ACTIVE_FILTER}
+    # A single prefix is enough to tell whether this Netbox version accepts the filter.
     try:
-        response = requests.get(f"{url}/api/ipam/prefixes",
-                                headers=headers,
-                                timeout=30,
-                                stream=True)
-        for raw_data in response.iter_lines():
-            if raw_data:
-                data = json.loads(raw_data)
-                for item in data["results"]:
-                    custom_field_name = module.params["customFieldName"]
-                    prefix = {"prefix": item["prefix"],
-                              **({"site": item["site"]["name"]}
-                              if item["site"] is not None else {}),
-                              **({"tenant": item["tenant"]["name"]}
-                              if item["tenant"] is not None else {}),
-                              **({"vlan": item["vlan"]["name"]}
-                              if item["vlan"] is not None else {}),
-                              **({"role": item["role"]["name"]}
-                              if item["role"] is not None else {}),
-                              **({custom_field_name:
-                                 item["custom_fields"][custom_field_name]}
-                              if custom_field_name in item["custom_fields"]
-                              else {}),
-                              **({"description": item["description"]}
-                              if item["description"] is not None else {})
-                              }
-                    prefixes.append(prefix)
-        return prefixes
-    except ConnectionError as exc:
+        fetch_netbox_graphql_page(module.params["netboxUrl"].rstrip("/"), headers, timings,
+                                  query, active, False, lambda item: item, 1, 0)
+    except NetboxGraphQLError as exc:
+        logging.info("Netbox rejected the GraphQL status filter, filtering the prefixes locally: %s", exc)
+        return filters
+    except (ConnectionError, requests.exceptions.RequestException) as exc:
         module.fail_json(msg=to_text(exc))
-        return None
+    return active
+
+
+def build_graphql_page_fetcher(module, headers, timings):
+    """ Bind the Netbox GraphQL query so only the limit and offset are left to pass """
+    normalize = functools.partial(normalize_prefix,
+                                  custom_field_name=module.params["customFieldName"])
+    query = build_graphql_query(module, headers, timings)
+    return functools.partial(fetch_netbox_graphql_page,
+                             module.params["netboxUrl"].rstrip("/"),
+                             headers,
+                             timings,
+                             query,
+                             build_graphql_filters(module, headers, timings, query),
+                             module.params["activeOnly"],
+                             normalize)
+
+
+def iter_pages(module, fetch_page):
+    """ Yield the normalized prefixes from each page returned by the fetcher in offset order """
+    # The first page tells us how many prefixes exist, the rest of the pages
+    # are then requested concurrently and yielded back in offset order.
+    workers = module.params["netboxWorkers"]
+    try:
+        count, page_size, first_page = fetch_page(module.params["netboxPageSize"], 0)
+        # Netbox caps the limit at its MAX_PAGE_SIZE, so step by what was actually returned.
+        yield from first_page
+        del first_page
+        if count is None:
+            # Without a count, a first page shorter than requested is the only page.
+            more = page_size >= module.params["netboxPageSize"]
+        else:
+            more = count > page_size
+        if page_size and more:
+            if count is None:
+                # Without a count keep requesting pages ahead until one comes back short.
+                offsets = itertools.count(page_size, page_size)
+            else:
+                offsets = iter(range(page_size, count, page_size))
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Keep a bounded window of pages in flight so memory does not grow with the IPAM size.
+                for offset in itertools.islice(offsets, workers * 2):
+                    pending.append(executor.submit(fetch_page, page_size, offset))
+                while pending:
+                    _count, size, page = pending.popleft().result()
+                    if count is None and size < page_size:
+                        # The last page, anything still in flight is past the end.
+                        for future in pending:
+                            future.cancel()
+                        pending.clear()
+                    else:
+                        offset = next(offsets, None)
+                        if offset is not None:
+                            pending.append(executor.submit(fetch_page, page_size, offset))
+                    yield from page
+    except (ConnectionError, requests.exceptions.RequestException, NetboxGraphQLError) as exc:
+        module.fail_json(msg=to_text(exc))
+
+
+def iter_prefixes(module, headers, timings, params=None, normalize=None):
+    """ Yield the normalized prefixes from the Netbox REST api page by page """
+    return iter_pages(module, build_page_fetcher(module, headers, timings, params, normalize))
+
+
+def iter_netbox_prefixes(module, headers, timings):
+    """ Yield the normalized prefixes from the Netbox api selected by the user """
+    if module.params["netboxApi"] == "graphql":
+        return iter_pages(module, build_graphql_page_fetcher(module, headers, timings))
+    return iter_prefixes(module, headers, timings)
+
+
+class PrefixTable:
+    """ Columnar, array backed table of normalized prefixes """
+
+    def __init__(self, names):
+        # Networks are kept as integers split over two 64 bit columns, and every
+        # attribute column holds ids into one list of interned values, -1 when unset.
+        self.versions = array("B")
+        self.high = array("Q")
+        self.low = array("Q")
+        self.lengths = array("B")
+        # Prefixes that are not in canonical form, or not networks at all, keep their original text by row.
+        self.originals = {}
+        self.columns = {name: array("i") for name in names}
+        self.values = []
+        self.value_ids = {}
+
+    def append(self, prefix):
+        """ Add a normalized prefix to the table, the prefix text is given back exactly as added """
+        text = prefix["prefix"]
+        network = parse_network(text)
+        if network is None:
+            self.originals[len(self)] = text
+            address = version = length = 0
+        else:
+            if str(network) != text:
+                self.originals[len(self)] = text
+            address = int(network.network_address)
+            version = network.version
+            length = network.prefixlen
+        self.versions.append(version)
+        self.high.append(address >> 64)
+        self.low.append(address & 0xFFFFFFFFFFFFFFFF)
+        self.lengths.append(length)
+        for name, column in self.columns.items():
+            if name not in prefix:
+                column.append(-1)
+                continue
+            # The type is part of the key, so 1, 1.0 and True stay distinct values.
+            key = (type(prefix[name]), populator_key(prefix[name]))
+            value_id = self.value_ids.get(key)
+            if value_id is None:
+                value_id = len(self.values)
+                self.value_ids[key] = value_id
+                self.values.append(prefix[name])
+            column.append(value_id)
+
+    def prefix(self, row):
+        """ Return the prefix string of a row """
+        if row in self.originals:
+            return self.originals[row]
+        if self.versions[row] == 4:
+            address = self.low[row]
+            return f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}/{self.lengths[row]}"
+        address = self.high[row] << 64 | self.low[row]
+        return str(ipaddress.IPv6Network((address, self.lengths[row])))
+
+    def __iter__(self):
+        for row in range(len(self)):
+            prefix = {"prefix": self.prefix(row)}
+            for name, column in self.columns.items():
+                if column[row] >= 0:
+                    prefix[name] = self.values[column[row]]
+            yield prefix
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+class DimensionPayload:
+    """ Rows of a prefix table grouped by the value of one attribute """
+
+    def __init__(self, table, addr_limit=None):
+        self.table = table
+        self.addr_limit = addr_limit
+        # Value id to the rows carrying it, in the order the values were first seen.
+        self.groups = {}
+
+    def add(self, value_id, row):
+        """ Add a row to the group of its value """
+        rows = self.groups.get(value_id)
+        if rows is None:
+            rows = self.groups[value_id] = array("i")
+        rows.append(row)
+
+    def items(self):
+        """ Yield every value with the list of its prefixes """
+        for value_id, rows in self.groups.items():
+            yield self.table.values[value_id], [self.table.prefix(row) for row in rows]
+
+    def upserts(self, direction):
+        """ Yield the populators for one direction, built as they are consumed """
+        addr_limit = self.addr_limit
+        for value, prefixes in self.items():
+            if addr_limit:
+                criteria = [{"direction": direction, "addr": prefixes[start:start + addr_limit]}
+                            for start in range(0, len(prefixes), addr_limit)]
+            else:
+                criteria = [{"direction": direction, "addr": [prefix]} for prefix in prefixes]
+            yield {"value": value, "criteria": criteria}
+
+    def payload(self, direction):
+        """ Return the batch payload for one direction, the upserts are built each time they are iterated """
+        return {"replace_all": True, "complete": True, "upserts": DirectionUpserts(self, direction)}
+
+    def __len__(self):
+        return len(self.groups)
+
+
+class DirectionUpserts:
+    """ Re-iterable view of the populators of a dimension for one direction """
+
+    def __init__(self, populators, direction):
+        self.populators = populators
+        self.direction = direction
+
+    def __iter__(self):
+        return self.populators.upserts(self.direction)
+
+
+class StoreDimension(DimensionPayload):
+    """ Prefixes of the local prefix cache grouped by the value of one attribute, in SQLite """
+
+    def __init__(self, store, name, addr_limit=None):
+        super().__init__(None, addr_limit)
+        self.store = store
+        self.column, self.decode = store.column(name)
+
+    def items(self):
+        """ Yield every value with the list of its prefixes, one value at a time """
+        # SQLite sorts the rows by value, so only the prefixes of the current value are held.
+        connection = sqlite3.connect(self.store.path)
+        try:
+            rows = connection.execute(
+                f"SELECT {self.column}, prefix FROM prefixes "
+                f"WHERE {self.column} IS NOT NULL ORDER BY {self.column}, id")
+            for value, group in itertools.groupby(rows, key=lambda row: row[0]):
+                yield self.decode(value), [row[1] for row in group]
+        finally:
+            connection.close()
+
+    def __len__(self):
+        connection = sqlite3.connect(self.store.path)
+        try:
+            return connection.execute(
+                f"SELECT COUNT(*) FROM (SELECT 1 FROM prefixes "
+                f"WHERE {self.column} IS NOT NULL GROUP BY {self.column})").fetchone()[0]
+        finally:
+            connection.close()
+
+
+def group_prefixes(prefixes, names, addr_limit=None):
+    """ Group the prefixes by value for every named attribute in a single pass """
+    if isinstance(prefixes, PrefixStore):
+        # The prefix cache is grouped by SQLite whenever a payload is built, nothing is loaded here.
+        groups = {name: StoreDimension(prefixes, name, addr_limit) for name in names}
+        logging.info("Grouping the cached prefixes by %s in the prefix cache", ", ".join(str(name) for name in groups))
+        return groups
+    if not isinstance(prefixes, PrefixTable):
+        table = PrefixTable(names)
+        for prefix in prefixes:
+            table.append(prefix)
+        prefixes = table
+    groups = {name: DimensionPayload(prefixes, addr_limit) for name in names}
+    columns = [(prefixes.columns[name], groups[name]) for name in groups if name in prefixes.columns]
+    for row in range(len(prefixes)):
+        for column, payload in columns:
+            value_id = column[row]
+            if value_id >= 0:
+                payload.add(value_id, row)
+    logging.info("Grouped %s prefixes by %s", len(prefixes), ", ".join(str(name) for name in groups))
+    return groups
+
+
+def collect_prefixes(module, headers, timings):
+    """ Collect the prefixes from Netbox into a prefix table, streaming only bounds the memory of each page """
+    names = ["site", "tenant", "vlan", "role", "description"]
+    if module.params["customFieldName"]:
+        names.append(module.params["customFieldName"])
+    prefixes = PrefixTable(names)
+    for prefix in iter_netbox_prefixes(module, headers, timings):
+        prefixes.append(prefix)
+    logging.info("Collected %s prefixes from Netbox", len(prefixes))
+    return prefixes
+
+
+class PrefixStore:
+    """ Re-iterable view of the prefixes held in the local SQLite prefix cache """
+
+    def __init__(self, path, custom_field_name):
+        self.path = path
+        self.custom_field_name = custom_field_name
+
+    def __iter__(self):
+        # Each pass runs a fresh query on its own connection so every enabled option
+        # can walk the prefixes, from any thread, without loading the whole table.
+        connection = sqlite3.connect(self.path)
+        cursor = connection.execute(
+            "SELECT prefix, site, tenant, vlan, role, custom_field, description "
+            "FROM prefixes ORDER BY id")
+        for row in cursor:
+            prefix = {"prefix": row[0]}
+            for name, value in zip(("site", "tenant", "vlan", "role"), row[1:5]):
+                if value is not None:
+                    prefix[name] = value
+            if row[5] is not None:
+                prefix[self.custom_field_name] = json.loads(row[5])
+            if row[6] is not None:
+                prefix["description"] = row[6]
+            yield prefix
+        connection.close()
+
+    def column(self, name):
+        """ Return the column holding a prefix attribute and the function decoding its values """
+        if name == self.custom_field_name:
+            return "custom_field", json.loads
+        if name in ("site", "tenant", "vlan", "role", "description"):
+            return name, str
+        raise KeyError(name)
+
+    def __len__(self):
+        connection = sqlite3.connect(self.path)
+        count = connection.execute("SELECT COUNT(*) FROM prefixes").fetchone()[0]
+        connection.close()
+        return count
+
+
+def normalize_cached_prefix(item, custom_field_name):
+    """ Normalize a prefix into a row for the local prefix cache """
+    prefix = normalize_prefix(item, custom_field_name)
+    custom_field = None
+    if custom_field_name in prefix:
+        custom_field = json.dumps(prefix[custom_field_name])
+    return (item["id"],
+            prefix["prefix"],
+            prefix.get("site"),
+            prefix.get("tenant"),
+            prefix.get("vlan"),
+            prefix.get("role"),
+            custom_field,
+            prefix.get("description"),
+            item["last_updated"])
+
+
+def open_prefix_store(path):
+    """ Open the local prefix cache, creating the tables when needed """
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS prefixes ("
+        "id INTEGER PRIMARY KEY, prefix TEXT NOT NULL, site TEXT, tenant TEXT, vlan TEXT, "
+        "role TEXT, custom_field TEXT, description TEXT, last_updated TEXT)")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+    return connection
+
+
+def prune_prefix_store(module, headers, timings, connection):
+    """ Remove prefixes from the cache that have been deleted in Netbox """
+    # The brief representation keeps this id listing cheap compared to a full pull.
+    params = {"brief": 1}
+    if module.params["netboxTrimFields"]:
+        params["fields"] = "id"
+    # The ids are collected in a temporary table so the comparison runs in SQLite, not in memory.
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS netbox_ids (id INTEGER PRIMARY KEY)")
+    connection.execute("DELETE FROM netbox_ids")
+    connection.executemany("INSERT OR IGNORE INTO netbox_ids VALUES (?)",
+                           ((prefix_id,) for prefix_id in
+                            iter_prefixes(module, headers, timings, params, normalize=lambda item: item["id"])))
+    removed = connection.execute("DELETE FROM prefixes WHERE id NOT IN (SELECT id FROM netbox_ids)").rowcount
+    connection.execute("DROP TABLE netbox_ids")
+    logging.info("Removed %s deleted prefixes from the prefix cache", removed)
+
+
+def sync_prefix_store(module, headers, timings):
+    """ Bring the local prefix cache up to date with Netbox and return a view of it """
+    custom_field_name = module.params["customFieldName"]
+    connection = open_prefix_store(module.params["prefixCache"])
+    state = dict(connection.execute("SELECT key, value FROM sync_state"))
+    watermark = state.get("last_updated")
+    signature = json.dumps({"custom_field": custom_field_name, "filters": build_netbox_filters(module)},
+                           sort_keys=True)
+    if state.get("signature") != signature:
+        # The cached rows were built for another custom field or filter, start over.
+        connection.execute("DELETE FROM prefixes")
+        watermark = None
+    params = {}
+    if watermark is not None:
+        params["last_updated__gte"] = watermark
+        logging.info("Syncing prefixes changed in Netbox since %s", watermark)
+    else:
+        logging.info("Prefix cache is empty, pulling every prefix from Netbox")
+    normalize = functools.partial(normalize_cached_prefix, custom_field_name=custom_field_name)
+    latest = {"last_updated": watermark, "rows": 0}
+
+    def track_rows():
+        for row in iter_prefixes(module, headers, timings, params, normalize):
+            latest["rows"] += 1
+            if latest["last_updated"] is None or row[8] > latest["last_updated"]:
+                latest["last_updated"] = row[8]
+            yield row
+
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               track_rows())
+        logging.info("Stored %s new or changed prefixes in the prefix cache", latest["rows"])
+        if watermark is not None:
+            # Deletes never show up in a last_updated query, and matching totals can hide a delete
+            # balanced by a create, so the cached ids are always checked against the Netbox ids.
+            prune_prefix_store(module, headers, timings, connection)
+        connection.executemany("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                               [("last_updated", latest["last_updated"]),
+                                ("signature", signature)])
+    connection.close()
+    return PrefixStore(module.params["prefixCache"], custom_field_name)
 
 
 def gather_choices(module):
@@ -215,20 +976,69 @@ def gather_choices(module):
     # build_choices = [decisions.update({name: value})  if "enable" in
     # name else logging.info("Skipping...")
     # for name, value in module.params.items()]
-    # List of functions to true or false decsions.
+    # List of functions to the prefix attribute their payload is grouped by and true or false decsions.
     # The dictionary keys are actually the function to execute as well.
     decisions = {
-        add_to_sites: module.params["enableSitebyIP"],
-        add_with_vlans: module.params["enableVlan"],
-        add_with_tenants: module.params["enableTenant"],
-        add_with_roles: module.params["enableRoles"],
-        add_with_descriptions: module.params["enableDescriptions"],
-        add_with_custom_fields: module.params["enableCustomFields"]
+        add_to_sites: ("site", module.params["enableSitebyIP"]),
+        dimension_option("vlan", module.params["vlanName"]): ("vlan", module.params["enableVlan"]),
+        dimension_option("tenant", module.params["tenantName"]): ("tenant", module.params["enableTenant"]),
+        dimension_option("role", module.params["roleName"]): ("role", module.params["enableRoles"]),
+        dimension_option("description", module.params["descriptionName"]):
+            ("description", module.params["enableDescriptions"]),
+        dimension_option(module.params["customFieldName"], module.params["customFieldName"]):
+            (module.params["customFieldName"], module.params["enableCustomFields"])
     }
     return decisions
 
 
-def add_to_sites(module, kentik_auth, warnings, prefixes):
+class NetworkIndex:
+    '''Longest prefix match index of the networks classified on each site.'''
+
+    def __init__(self):
+        # One hash table per ip version and prefix length, mapping the network
+        # integer to the sites it is classified on. A lookup probes at most one
+        # table per prefix length, so it is bounded by the length of the prefix.
+        self.tables = {4: {}, 6: {}}
+
+    def add(self, prefix, site):
+        '''Index the prefix for the site, anything that is not a network is ignored.'''
+        network = parse_network(prefix)
+        if network is None:
+            return
+        table = self.tables[network.version].setdefault(network.prefixlen, {})
+        table.setdefault(int(network.network_address), set()).add(site)
+
+    def covers(self, prefix, site):
+        '''Return True when the site already has a network equal to or covering the prefix.'''
+        network = parse_network(prefix)
+        if network is None:
+            return False
+        address = int(network.network_address)
+        for length, table in self.tables[network.version].items():
+            if length <= network.prefixlen:
+                host_bits = network.max_prefixlen - length
+                if site in table.get(address >> host_bits << host_bits, ()):
+                    return True
+        return False
+
+
+def parse_network(prefix):
+    '''Parse a prefix into an ip network, returns None if it is not one.'''
+    try:
+        return ipaddress.ip_network(prefix, strict=False)
+    except ValueError:
+        return None
+
+
+def network_order(prefix):
+    '''Sort key putting broader networks first, anything that is not a network goes last.'''
+    network = parse_network(prefix)
+    if network is None:
+        return (7, 0)
+    return (network.version, network.prefixlen)
+
+
+def add_to_sites(module, client, warnings, poller, checkpoints, dimensions, compressor, groups):
     '''Function to update site by ip classication'''
 
     # Step one is to build the paylooad based on the current option selected.
@@ -239,376 +1049,529 @@ def add_to_sites(module, kentik_auth, warnings, prefixes):
     #       - Then we could read the prefixes from the database locally and stream to kentik?
     #       - Can the kentik api support streaming uploads or uploads spaced out over time?
     # Step two is to allow the
+    # Group the prefixes by site first, if that grouping has not changed since the
+    # last successful run there is nothing to merge and the sites are left alone.
+    # Only prefixes with a site configured are grouped.
+    site_prefixes = dict(groups["site"].items())
+    digest = payload_digest(sorted(site_prefixes.items()))
+    if checkpoints.matches("sites", digest):
+        logging.info("Site prefixes are unchanged since the last run")
+        result = {"Sites": "No Change"}
+        return result
     # Gather a list of sites
-    if module.params["region"] == "EU":
-        url = "https://grpc.api.kentik.eu"
-    else:
-        url = "https://grpc.api.kentik.com"
-    try:
-        response = requests.request(
-            "GET", f"{url}/site/v202211/sites", headers=kentik_auth, timeout=30
-        )
-        response.raise_for_status()
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
+    response = client.request("GET", client.grpc_url("/site/v202211/sites"))
     sites = response.json()
     site_dict = {}
+    # Set backed index of the networks already on each site for constant time membership checks,
+    # plus a longest prefix match index so prefixes covered by a broader network are skipped.
+    site_networks = {}
+    network_index = NetworkIndex()
     for site in sites["sites"]:
-        # if the list is empty, need to clear the blank element.
-        if site["addressClassification"]["otherNetworks"] == '':
-            site["addressClassification"]["otherNetworks"] = []
         site_dict[site["title"]] = site
-    # Create a prefix list to be used later to remove sites from being updated.
-    prefix_list = []
-    for prefix in prefixes:
-        # Make sure the prefix has a site configured.
-        if "site" in prefix:
-            # Make sure that the prefixes site is a site that already exists in kentik.
-            if prefix["site"] in site_dict:
-                # Make sure that the prefix is not already configured in the site.
-                if prefix["prefix"] not in site_dict[prefix["site"]]["addressClassification"]["otherNetworks"]:
-                    site_dict[prefix["site"]]["addressClassification"]["otherNetworks"].append(
-                        prefix["prefix"])
-                    prefix_list.append(prefix["site"])
-            else:
-                site_warning = prefix["site"]
-                warnings.append(f"Site does not exist: {site_warning}")
+        site_networks[site["title"]] = set()
+        for classification in SITE_CLASSIFICATIONS:
+            # if the list is empty, need to clear the blank element.
+            if site["addressClassification"].get(classification) in ('', None):
+                site["addressClassification"][classification] = []
+            for network in site["addressClassification"][classification]:
+                site_networks[site["title"]].add(network)
+                network_index.add(network, site["title"])
+    # Track the sites that need to be updated and the ones missing from kentik.
+    changed_sites = set()
+    missing_sites = set()
+    for site_name, site_prefix_list in site_prefixes.items():
+        # Make sure that the prefixes site is a site that already exists in kentik.
+        if site_name not in site_dict:
+            missing_sites.add(site_name)
+            continue
+        # Broader networks go first so a prefix is checked against every network that covers it,
+        # whatever order Netbox or the prefix cache returned them in.
+        for prefix in sorted(site_prefix_list, key=network_order):
+            # Make sure that the prefix is not already configured in, or covered by, the site.
+            if prefix not in site_networks[site_name] and not network_index.covers(prefix, site_name):
+                site_networks[site_name].add(prefix)
+                network_index.add(prefix, site_name)
+                site_dict[site_name]["addressClassification"]["otherNetworks"].append(prefix)
+                changed_sites.add(site_name)
+    for site_name in sorted(missing_sites):
+        warnings.append(f"Site does not exist: {site_name}")
+    # A missing site may be created in kentik later, so its prefixes are only
+    # checkpointed once every site exists and they could all be applied.
+    record = not missing_sites
     # Remove sites from the update list that do not need to be updated.
-    if not prefix_list:
+    if not changed_sites:
+        if record:
+            checkpoints.record("sites", digest)
         result = {"Sites": "No Change"}
         return result
-    for name, config in site_dict.items():
-        if name not in prefix_list:
+    for name in site_dict:
+        if name not in changed_sites:
             logging.info("Site (%s) does not need updated", name)
-            continue
-        try:
-            logging.info("Updating site (%s)", name)
-            config_id = config["id"]
-            response = requests.request(
-                "PUT",
-                f"{url}/site/v202211/sites/{config_id}",
-                headers=kentik_auth,
-                data=json.dumps({"site": config}),
-                timeout=30
-            )
-            response.raise_for_status()
-        except ConnectionError as exc:
-            module.fail_json(msg=to_text(exc))
+    run_concurrently(module, module.params["kentikWorkers"],
+                     [functools.partial(update_site, client, compressor, site_dict[name])
+                      for name in sorted(changed_sites)])
+    if record:
+        checkpoints.record("sites", digest)
     result = {"Sites": "Success"}
     return result
 
 
-def build_batch_payload(prefixes, name):
+def update_site(client, compressor, config):
+    '''Function to push an updated site configuration to kentik'''
+    logging.info("Updating site (%s)", config["title"])
+    config_id = config["id"]
+    headers, body = compressor.prepare({}, json.dumps({"site": config}).encode("utf-8"))
+    with client.timings.phase("upload"):
+        client.request("PUT", client.grpc_url(f"/site/v202211/sites/{config_id}"), data=body, headers=headers)
+
+
+def populator_key(value):
+    """ Return a hashable key for a populator value, custom fields may hold lists or objects """
+    if isinstance(value, Hashable):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+
+def criteria_addr_limit(module):
+    '''Return how many addresses to pack into each populator criteria, None when packing is off.'''
+    if module.params["packPopulators"]:
+        return module.params["populatorAddrLimit"]
+    return None
+
+
+def build_batch_payload(prefixes, name, addr_limit=None):
     '''Function to create the batch payload and return the set of dictionaries.'''
-    json_data_src = {"replace_all": True, "complete": True, "upserts": []}
-    json_data_dst = {"replace_all": True, "complete": True, "upserts": []}
-    for prefix in prefixes:
-        if name in prefix:
-            if not json_data_src["upserts"]:
-                logging.info("First pass creating the payload for %s", name)
-                json_data_src["upserts"] = [{"value": prefix[name],
-                                            "criteria": [{"direction": "src",
-                                             "addr": [prefix["prefix"]]}]}]
-                json_data_dst["upserts"] = [{"value": prefix[name],
-                                            "criteria": [{"direction": "dst",
-                                             "addr": [prefix["prefix"]]}]}]
-            else:
-                # Assuming the list is not empty we will search for an existing value.
-                for index, item in enumerate(json_data_src["upserts"]):
-                    if prefix[name] in item.values():
-                        # If a value is found we add the prefix to that populator.
-                        json_data_src["upserts"][index]["criteria"].append(
-                            {"direction": "src",
-                             "addr": [prefix["prefix"]]})
-                        json_data_dst["upserts"][index]["criteria"].append(
-                            {"direction": "dst",
-                             "addr": [prefix["prefix"]]})
-                    elif index == len(json_data_src["upserts"]) - 1:
-                        # Otherwise we will add a new item as soon
-                        # as we have searched through the entire list.
-                        json_data_src["upserts"].append(
-                            {"value": prefix[name],
-                             "criteria": [{"direction": "src",
-                                           "addr": [prefix["prefix"]]}]})
-                        json_data_dst["upserts"].append(
-                            {"value": prefix[name],
-                             "criteria": [{"direction": "dst",
-                                           "addr": [prefix["prefix"]]}]})
+    logging.info("Creating the payload for %s", name)
+    populators = group_prefixes(prefixes, [name], addr_limit)[name]
+    json_data_src = populators.payload("src")
+    json_data_dst = populators.payload("dst")
+    json_data_src["upserts"] = list(json_data_src["upserts"])
+    json_data_dst["upserts"] = list(json_data_dst["upserts"])
     return json_data_src, json_data_dst
 
 
-def create_custom_dimension(module, kentik_auth, name, direction):
+def create_custom_dimension(client, name, direction):
     '''Function to create the custom dimension'''
-    if module.params["region"] == "EU":
-        url = "https://api.kentik.eu/api/v5/customdimension"
-    else:
-        url = "https://api.kentik.com/api/v5/customdimension"
     payload = {"name": f"c_{direction}_{name}",
                "type": "string",
                "display_name": name.replace("_", " ").upper()}
-    try:
-        logging.info("Creating the custom dimension: %s", name)
-        response = requests.request("POST",
-                                    url,
-                                    headers=kentik_auth,
-                                    data=json.dumps(payload),
-                                    timeout=30)
-        if response.status_code < 200 or response.status_code >= 300:
-            module.fail_json(msg=response.text)
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
+    logging.info("Creating the custom dimension: %s", name)
+    response = client.request("POST", client.api_url("/customdimension"), payload=payload)
     return response.status_code
 
 
-def http_request_func(method, url, headers, payload, module, retries=0):
-    """Function for hanlding HTTP Requests"""
-    if retries < 3:
-        try:
-            response = requests.request(
-                method, url, headers=headers, data=payload, timeout=30
-            )
-            if response.status_code == 200:
-                logging.info("%s HTTP Request Successfull for url: %s", method, url)
-            elif response.status_code == 429:
-                if 'x-ratelimit-reset' in response.headers:
-                    time.sleep(int(response.headers['x-ratelimit-reset']))
-                else:
-                    time.sleep(60)
-                retries += 1
-                http_request_func(method, url, headers, payload, module, retries)
-            elif response.status_code == 404:
-                return False
-            else:
-                module.fail_json(msg=response.text)
-            if 'x-ratelimit-remaining' in response.headers:
-                if int(response.headers['x-ratelimit-remaining']) < 10:
-                    time.sleep(10)  # Helps to slow down the rate of execution for throttling.
-        except ConnectionError as exc:
-            module.fail_json(msg=to_text(exc))
-    else:
-        module.fail_json(msg="ERROR - RETRIED 3 TIMES")
-    return response
+def chunk_upserts(upserts, max_bytes):
+    '''Split the upserts into parts whose serialized size stays under max_bytes.'''
+    # A populator is never split, a value repeated in a later part would replace the earlier criteria.
+    part = []
+    part_bytes = 0
+    for upsert in upserts:
+        upsert_bytes = len(json.dumps(upsert))
+        if part and part_bytes + upsert_bytes > max_bytes:
+            yield part
+            part = []
+            part_bytes = 0
+        part.append(upsert)
+        part_bytes += upsert_bytes
+    yield part
 
 
-def run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, name):
-    '''Function to add populators in bulk to kentik, returns success or failure.'''
-    # Start with source dimension.
-    if module.params["region"] == "EU":
-        url = "https://api.kentik.eu/api/v5/batch"
-    else:
-        url = "https://api.kentik.com/api/v5/batch"
-    if len(json_data_src["upserts"]) == 0:
-        return "FAILED-EMPTY"
-    logging.info("Adding or updating the source custom dimensions for %s", name)
+def iter_batch_body(json_data, upserts):
+    '''Yield the json body of a batch request in chunks, encoding the upserts as they are consumed.'''
+    # Everything but the upserts is small, so it is encoded up front and the upserts list is left open.
+    chunk = [json.dumps(json_data)[:-1], ', "upserts": [']
+    chunk_bytes = 0
+    separator = ""
+    for upsert in upserts:
+        encoded = json.dumps(upsert)
+        chunk.append(separator)
+        chunk.append(encoded)
+        separator = ", "
+        chunk_bytes += len(encoded)
+        if chunk_bytes >= BATCH_BODY_CHUNK_BYTES:
+            yield "".join(chunk).encode("utf-8")
+            chunk = []
+            chunk_bytes = 0
+    chunk.append("]}")
+    yield "".join(chunk).encode("utf-8")
+
+
+def send_batch_part(client, compressor, url, json_data, upserts):
+    '''Function to send a batch part, encoding it into a spooled body as the upserts are consumed.'''
+    # The spooled body is sent with its Content-Length rather than chunked,
+    # and the client sends it again when kentik throttles it.
+    headers, body = compressor.prepare({}, iter_batch_body(json_data, upserts))
+    if isinstance(body, bytes):
+        return client.send("POST", url, data=body, headers=headers)
+    body = SpooledBody(body)
     try:
-        response = requests.request("POST",
-                                    f"{url}/customdimensions/c_src_{name}/populators",
-                                    headers=kentik_auth,
-                                    data=json.dumps(json_data_src),
-                                    timeout=30)
-        if response.status_code != 200 and "Invalid column" in response.json()["error"]:
-            logging.info("Source dimension, %s, does not exist.", name)
-            warnings.append({"Source dimension does not exist.": name})
-            create_custom_dimension(module, kentik_auth, name, "src")
-            response = requests.request("POST",
-                                        f"{url}/customdimensions/c_src_{name}/populators",
-                                        headers=kentik_auth,
-                                        data=json.dumps(json_data_dst),
-                                        timeout=30)
-        if response.status_code < 200 and response.status_code >= 300:
-            module.fail_json(msg=response.json()["error"])
-        guid = response.json()["guid"]
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
-    times = 0
+        return client.send("POST", url, data=body, headers=headers)
+    finally:
+        body.close()
+
+
+def response_error(response):
+    '''Function to return the error message of a failed kentik response, its text when there is none.'''
     try:
-        logging.info("Validating that the source custom dimension for %s has been updated.", name)
-        response = requests.request("GET", f"{url}/{guid}/status",
-                                    headers=kentik_auth,
-                                    data=json.dumps(json_data_src),
-                                    timeout=30)
-        while not response.json()["is_complete"]:
-            if times < 5:
-                logging.info("Validating status for %s: %s times.", name, times)
-                time.sleep(5)
-                response = requests.request("GET",
-                                            f"{url}/{guid}/status",
-                                            headers=kentik_auth,
-                                            data=json.dumps(json_data_src),
-                                            timeout=30)
-                times += 1
-            else:
-                module.fail_json(msg=f"TIMEOUT - failed to validate batch status for {guid}")
-                break
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
-    # Run the same automation for the destination custom dimensions
+        error = response.json().get("error")
+    except (ValueError, AttributeError):
+        error = None
+    return to_text(error) if error else response.text
+
+
+def post_batch_part(module, client, warnings, compressor, url, name, direction, json_data, upserts):
+    '''Function to post a single batch request, creating the custom dimension if needed.'''
+    # The body is encoded into a spooled file and encoded again for the retry,
+    # so the serialized payload is never held in memory past SPOOL_MEMORY_BYTES.
+    populators_url = f"{url}/customdimensions/c_{direction}_{name}/populators"
     try:
-        logging.info("Adding or updating the destination custom dimensions for %s", name)
-        response = requests.request("POST",
-                                    f"{url}/customdimensions/c_dst_{name}/populators",
-                                    headers=kentik_auth,
-                                    data=json.dumps(json_data_dst),
-                                    timeout=30)
+        response = send_batch_part(client, compressor, populators_url, json_data, upserts)
         # Checking to see if the response code failed due to the custom dimension not being created.
-        if response.status_code != 200 and "Invalid column" in response.json()["error"]:
+        if response.status_code != 200 and "Invalid column" in response_error(response):
             # Create the custom dimension and try again.
-            logging.info("Destination dimension, %s, does not exist.", name)
-            create_custom_dimension(module, kentik_auth, name, "dst")
-            response = requests.request("POST",
-                                        f"{url}/customdimensions/c_dst_{name}/populators",
-                                        headers=kentik_auth,
-                                        data=json.dumps(json_data_dst),
-                                        timeout=30)
-        if response.status_code < 200 and response.status_code >= 300:
-            module.fail_json(msg=response.json()["error"])
-        # Captures the GUID in order to check the status of the batch.
-        guid = response.json()["guid"]
-    except ConnectionError as exc:
-        module.fail_json(msg=to_text(exc))
-    # Setting a counter for the while loop.
-    times = 0
-    # Accessing the batch status url using the guid above to ensure that the job is complete.
-    try:
-        logging.info(
-            "Validating that the destination custom dimension for %s has been updated.", name)
-        response = requests.request("GET",
-                                    f"{url}/{guid}/status",
-                                    headers=kentik_auth,
-                                    data=json.dumps(json_data_src),
-                                    timeout=30)
-        # Checking for the is_complete to be true and looping until it is or the counter fails.
-        while not response.json()["is_complete"]:
-            if times < 5:
-                logging.info("Validating status for %s: %s times.", name, times)
-                time.sleep(5)
-                response = requests.request("GET",
-                                            f"{url}/{guid}/status",
-                                            headers=kentik_auth,
-                                            data=json.dumps(json_data_src),
-                                            timeout=30)
-                times += 1
-            else:
-                module.fail_json(msg=f"TIMEOUT - failed to validate batch status for {guid}")
-                break
-    except ConnectionError as exc:
+            logging.info("The %s dimension, %s, does not exist.", direction, name)
+            warnings.append({f"The {direction} dimension does not exist.": name})
+            create_custom_dimension(client, name, direction)
+            response = send_batch_part(client, compressor, populators_url, json_data, upserts)
+        if response.status_code < 200 or response.status_code >= 300:
+            module.fail_json(msg=response_error(response))
+    except (ConnectionError, requests.exceptions.RequestException) as exc:
         module.fail_json(msg=to_text(exc))
-    # Return success to be used by the calling function.
-    # No failure return is done, instead the module fails.
-    return "SUCCESS"
+    return response.json()["guid"]
 
 
-def add_with_region(module, kentik_auth, warnings, prefixes):
-    '''Function to create custom dimensions based off of region'''
-    dimension = "region"
-    # Build the payload.
-    json_data_src, json_data_dst = build_batch_payload(prefixes, dimension)
-    # Attempt to add the new elements.
-    status = run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, dimension)
-    # Setting the variable outside of the if statement first.
-    result = {dimension: "Failed"}
-    if status == "SUCCESS":
-        result = {dimension: "Success"}
+def post_populators(module, client, warnings, compressor, url, name, direction, json_data):
+    '''Function to upload the populators for one direction, returns the batch guid.'''
+    if module.params["batchPartBytes"]:
+        parts = chunk_upserts(json_data["upserts"], module.params["batchPartBytes"])
     else:
-        module.fail_json(msg=f"FAILED TO ADD AND UPDATE CUSTOM DIMENSIONS FOR {dimension}")
-    return result
+        # The upserts are only built when the body is encoded for kentik.
+        parts = iter([json_data["upserts"]])
+    guid = None
+    # Parts are built one ahead of the upload, just far enough to know which one is the last.
+    upserts = next(parts)
+    index = 0
+    while upserts is not None:
+        following = next(parts, None)
+        # Every part shares the guid of the first one and only the last part completes the batch.
+        part = {"replace_all": json_data["replace_all"],
+                "complete": following is None}
+        if guid is not None:
+            part["guid"] = guid
+        elif json_data.get("deletes"):
+            part["deletes"] = json_data["deletes"]
+        index += 1
+        logging.info("Uploading part %s for the %s dimension %s", index, direction, name)
+        guid = post_batch_part(module, client, warnings, compressor, url, name, direction, part, upserts)
+        upserts = following
+    return guid
 
 
-def add_with_vlans(module, kentik_auth, warnings, prefixes):
-    '''Function to create custom dimensions based off of vlan'''
-    # Declaring the name of the dimension.
-    dimension = module.params["vlanName"]
-    # Build the payload.
-    json_data_src, json_data_dst = build_batch_payload(prefixes, "vlan")
-    # Attempt to add the new elements.
-    status = run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, dimension)
-    # Setting the variable outside of the if statement first.
-    result = {dimension: "Failed"}
-    if status == "SUCCESS":
-        result = {dimension: "Success"}
-    elif status == "FAILED-EMPTY":
-        result[dimension] = "EMPTY"
-    else:
-        module.fail_json(msg=f"FAILED TO ADD AND UPDATE CUSTOM DIMENSIONS FOR {dimension}")
-    return result
+class BatchPoller:
+    '''Shared poller that tracks the status of every outstanding batch guid from one thread.'''
 
+    def __init__(self, module, client, url):
+        self.module = module
+        self.client = client
+        self.url = url
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.timings = {}
+        self.thread = None
 
-def add_with_tenants(module, kentik_auth, warnings, prefixes):
-    '''Function to create custom dimensions based off of tenants'''
-    # Declaring the name of the dimension.
-    dimension = module.params["tenantName"]
-    # Build the payload.
-    json_data_src, json_data_dst = build_batch_payload(prefixes, "tenant")
-    # Attempt to add the new elements.
-    status = run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, dimension)
-    # Setting the variable outside of the if statement first.
-    result = {dimension: "Failed"}
-    if status == "SUCCESS":
-        result = {dimension: "Success"}
-    elif status == "FAILED-EMPTY":
-        result[dimension] = "EMPTY"
-    else:
-        module.fail_json(msg=f"FAILED TO ADD AND UPDATE CUSTOM DIMENSIONS FOR {dimension}")
-    return result
+    def wait(self, guid, name, direction):
+        '''Block until the batch for the guid has been applied and return its timing.'''
+        now = time.monotonic()
+        state = {"name": name,
+                 "direction": direction,
+                 "started": now,
+                 "next_poll": now,
+                 "interval": self.module.params["batchPollInterval"],
+                 "polls": 0,
+                 "error": None,
+                 "done": threading.Event()}
+        with self.condition:
+            self.pending[guid] = state
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        # The poller times the batch out itself, this only guards against it never answering.
+        if not state["done"].wait(self.module.params["batchTimeout"] + BATCH_POLL_MAX_INTERVAL + self.client.timeout):
+            self.module.fail_json(msg=f"TIMEOUT - failed to validate batch status for {guid}")
+        if state["error"] is not None:
+            self.module.fail_json(msg=state["error"])
+        return self.timings[guid]
 
+    def run(self):
+        '''Poll whichever guid is due next until nothing is left to track.'''
+        try:
+            while True:
+                with self.condition:
+                    if not self.pending:
+                        self.thread = None
+                        return
+                    guid, state = min(self.pending.items(), key=lambda item: item[1]["next_poll"])
+                    delay = state["next_poll"] - time.monotonic()
+                    if delay > 0:
+                        # Woken early when a new guid is registered, which may be due sooner.
+                        self.condition.wait(delay)
+                        continue
+                self.poll(guid, state)
+        finally:
+            with self.condition:
+                # Only reached with work left when the thread died, release every waiter
+                # so the next guid starts a new poller instead of waiting forever.
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                    for state in self.pending.values():
+                        state["error"] = "Batch status polling stopped unexpectedly"
+                        state["done"].set()
+                    self.pending.clear()
 
-def add_with_roles(module, kentik_auth, warnings, prefixes):
-    '''Function to create custom dimensions based off of roles'''
-    # Declaring the name of the dimension.
-    dimension = module.params["roleName"]
-    # Build the payload.
-    json_data_src, json_data_dst = build_batch_payload(prefixes, "role")
-    # Attempt to add the new elements.
-    status = run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, dimension)
-    # Setting the variable outside of the if statement first.
-    result = {dimension: "Failed"}
-    if status == "SUCCESS":
-        result = {dimension: "Success"}
-    elif status == "FAILED-EMPTY":
-        result[dimension] = "EMPTY"
-    else:
-        module.fail_json(msg=f"FAILED TO ADD AND UPDATE CUSTOM DIMENSIONS FOR {dimension}")
-    return result
+    def poll(self, guid, state):
+        '''Check a single guid and either finish it or back off before the next check.'''
+        logging.info("Validating status for %s (%s): %s times.", state["name"], state["direction"], state["polls"])
+        state["polls"] += 1
+        try:
+            response = self.client.send("GET", f"{self.url}/{guid}/status")
+            if response.status_code == 429:
+                # Still throttled after the client retries, check again after the backoff.
+                is_complete = False
+            elif response.status_code != 200:
+                self.finish(guid, state, f"Failed to validate batch status for {guid}: {response.text}")
+                return
+            else:
+                is_complete = response.json()["is_complete"]
+        except (ConnectionError, requests.exceptions.RequestException) as exc:
+            self.finish(guid, state, to_text(exc))
+            return
+        except Exception as exc:
+            # Anything escaping here would kill the poller thread and strand the waiters.
+            self.finish(guid, state, f"Failed to validate batch status for {guid}: {exc!r}")
+            return
+        elapsed = time.monotonic() - state["started"]
+        if is_complete:
+            self.timings[guid] = {"name": state["name"],
+                                  "direction": state["direction"],
+                                  "seconds": round(elapsed, 3),
+                                  "polls": state["polls"]}
+            self.finish(guid, state, None)
+        elif elapsed >= self.module.params["batchTimeout"]:
+            self.finish(guid, state, f"TIMEOUT - failed to validate batch status for {guid}")
+        else:
+            state["next_poll"] = time.monotonic() + state["interval"]
+            state["interval"] = min(state["interval"] * 2, BATCH_POLL_MAX_INTERVAL)
 
+    def finish(self, guid, state, error):
+        '''Stop tracking the guid and release its waiter.'''
+        with self.condition:
+            del self.pending[guid]
+        state["error"] = error
+        state["done"].set()
 
-def add_with_descriptions(module, kentik_auth, warnings, prefixes):
-    '''Function to create custom dimensions based off of descriptions'''
-    # Declaring the name of the dimension.
-    dimension = module.params["descriptionName"]
-    # Build the payload.
-    json_data_src, json_data_dst = build_batch_payload(prefixes, "description")
-    # Attempt to add the new elements.
-    status = run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, dimension)
-    # Setting the variable outside of the if statement first.
-    result = {dimension: "Failed"}
-    if status == "SUCCESS":
-        result = {dimension: "Success"}
-    elif status == "FAILED-EMPTY":
-        result[dimension] = "EMPTY"
-    else:
-        module.fail_json(msg=f"FAILED TO ADD AND UPDATE CUSTOM DIMENSIONS FOR {dimension}")
-    return result
 
+def payload_digest(items):
+    '''Return a stable hash of the canonical json form of the items of a payload.'''
+    digest = hashlib.sha256()
+    # Hash the items one by one, so a generated payload is never held in memory as a whole.
+    for item in items:
+        for chunk in CANONICAL_ENCODER.iterencode(item):
+            digest.update(chunk.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
 
-def add_with_custom_fields(module, kentik_auth, warnings, prefixes):
-    '''Function to create custom dimensions based off of custom fields'''
-    # Declaring the name of the dimension. TODO: Make this settable by the user.
-    dimension = module.params["customFieldName"]
-    # Build the payload.
-    json_data_src, json_data_dst = build_batch_payload(prefixes, dimension)
+
+class CheckpointStore:
+    '''Hashes of the payloads that were successfully applied to kentik on previous runs.'''
+
+    def __init__(self, path, namespace, check_mode=False, ignore=False):
+        self.path = path
+        self.namespace = namespace
+        # Nothing is recorded in check mode, and ignored checkpoints never match but are still recorded.
+        self.check_mode = check_mode
+        self.ignore = ignore
+        self.lock = threading.Lock()
+        self.hashes = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as checkpoint_file:
+                self.hashes = json.load(checkpoint_file)
+
+    @property
+    def enabled(self):
+        '''Return True when a checkpoint file is configured.'''
+        return self.path is not None
+
+    def matches(self, key, digest):
+        '''Return True when the payload for the key was already applied.'''
+        if self.path is None or self.ignore:
+            return False
+        return self.hashes.get(f"{self.namespace}/{key}") == digest
+
+    def record(self, key, digest):
+        '''Remember the payload for the key as applied.'''
+        if self.check_mode:
+            return
+        with self.lock:
+            self.hashes[f"{self.namespace}/{key}"] = digest
+
+    def save(self):
+        '''Write the checkpoints back to disk, replacing the file atomically.'''
+        if self.path is None or self.check_mode:
+            return
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as checkpoint_file:
+            json.dump(self.hashes, checkpoint_file, sort_keys=True, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def gather_custom_dimensions(client):
+    '''Function to gather the existing custom dimensions and their populators keyed by name.'''
+    logging.info("Gathering the existing custom dimensions")
+    response = client.request("GET", client.api_url("/customdimensions"))
+    return {dimension["name"].lower(): dimension for dimension in response.json()["customDimensions"]}
+
+
+class DimensionCatalog:
+    '''The existing custom dimensions and their populators, fetched once per run and shared by every option.'''
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.dimensions = None
+
+    def get(self):
+        '''Return the custom dimensions keyed by name, fetching them the first time they are needed.'''
+        # Every option diffs against its own dimensions, so the listing taken by the first one
+        # stays current for the others.
+        with self.lock:
+            if self.dimensions is None:
+                self.dimensions = gather_custom_dimensions(self.client)
+            return self.dimensions
+
+
+def populator_addresses(addr):
+    '''Return the set of addresses of a populator, kentik returns them comma separated.'''
+    if isinstance(addr, str):
+        return {address.strip() for address in addr.split(",") if address.strip()}
+    return set(addr)
+
+
+def populator_criteria(populators):
+    '''Return the addresses of the populators of one value, keyed by the rest of their criteria.'''
+    # Packing only changes how the addresses are split over populators, so the addresses are
+    # compared as one set per combination of the other criteria, such as direction or port.
+    criteria = {}
+    for populator in populators:
+        fields = {key: str(value).lower() if key == "direction" else value
+                  for key, value in populator.items()
+                  if key != "addr" and key not in POPULATOR_METADATA and value not in (None, "", [])}
+        addresses = criteria.setdefault(CANONICAL_ENCODER.encode(fields), set())
+        addresses.update(populator_addresses(populator.get("addr") or ()))
+    return criteria
+
+
+def diff_populators(json_data, dimension):
+    '''Function to reduce a full batch payload down to the populators that changed.'''
+    existing = {}
+    for populator in dimension.get("populators") or []:
+        existing.setdefault(str(populator["value"]), []).append(populator)
+    upserts = []
+    desired = set()
+    for upsert in json_data["upserts"]:
+        value = str(upsert["value"])
+        desired.add(value)
+        # An upsert replaces every populator with the same value, so only changed values are sent.
+        if value not in existing or populator_criteria(existing[value]) != populator_criteria(upsert["criteria"]):
+            upserts.append(upsert)
+    deletes = [{"value": value} for value in existing if value not in desired]
+    return {"replace_all": False, "complete": True, "upserts": upserts, "deletes": deletes}
+
+
+def upload_direction(module, client, warnings, poller, compressor, name, direction, json_data):
+    '''Function to upload and validate the populators for a single direction.'''
+    logging.info("Adding or updating the %s custom dimensions for %s", direction, name)
+    with client.timings.phase("upload"):
+        guid = post_populators(module, client, warnings, compressor, poller.url, name, direction, json_data)
+    with client.timings.phase("poll"):
+        poller.wait(guid, name, direction)
+
+
+def run_batch_url(module, client, warnings, poller, checkpoints, dimensions, compressor, populators, name):
+    '''Function to add populators in bulk to kentik, returns success or failure.'''
+    empty = len(populators) == 0
+    diff = module.params["populatorSync"] == "diff"
+    # When diffing, an empty dimension still removes the values left behind in kentik.
+    if empty and not diff:
+        return "FAILED-EMPTY"
+    # The src and dst payloads are only derived from the grouped prefixes when they are serialized.
+    digests = {}
+    payloads = []
+    for direction in ("src", "dst"):
+        if checkpoints.enabled:
+            digests[direction] = payload_digest(populators.upserts(direction))
+        if checkpoints.matches(f"c_{direction}_{name}", digests.get(direction)):
+            logging.info("The %s payload for %s is unchanged since the last run", direction, name)
+        else:
+            payloads.append((direction, populators.payload(direction)))
+    if not payloads:
+        return "NO-CHANGE"
+    if diff:
+        # Only send what changed compared to the populators already in kentik.
+        # Dimensions that do not exist yet still get the full payload.
+        existing = dimensions.get()
+        changed = []
+        for direction, json_data in payloads:
+            dimension = existing.get(f"c_{direction}_{name}".lower())
+            if dimension is not None:
+                json_data = diff_populators(json_data, dimension)
+                if not json_data["upserts"] and not json_data["deletes"]:
+                    logging.info("The %s dimension for %s does not need updated", direction, name)
+                    checkpoints.record(f"c_{direction}_{name}", digests.get(direction))
+                    continue
+            elif empty:
+                # There is nothing to remove and nothing to create the dimension with.
+                continue
+            changed.append((direction, json_data))
+        payloads = changed
+        if not payloads:
+            return "FAILED-EMPTY" if empty else "NO-CHANGE"
+    # The source and destination dimensions are independent so upload them side by side.
+    run_concurrently(module, 2,
+                     [functools.partial(upload_direction, module, client, warnings, poller, compressor,
+                                        name, direction, json_data)
+                      for direction, json_data in payloads])
+    for direction, _json_data in payloads:
+        checkpoints.record(f"c_{direction}_{name}", digests.get(direction))
+    # Return success to be used by the calling function.
+    # No failure return is done, instead the module fails.
+    return "SUCCESS"
+
+
+def add_with_dimension(module, client, warnings, poller, checkpoints, dimensions, compressor, groups, field, dimension):
+    '''Function to create custom dimensions based off of one prefix attribute'''
+    # The prefixes grouped by the attribute.
+    populators = groups[field]
     # Attempt to add the new elements.
-    status = run_batch_url(module, kentik_auth, warnings, json_data_src, json_data_dst, dimension)
+    status = run_batch_url(module, client, warnings, poller, checkpoints, dimensions, compressor, populators,
+                           dimension)
     # Setting the variable outside of the if statement first.
     result = {dimension: "Failed"}
     if status == "SUCCESS":
         result = {dimension: "Success"}
     elif status == "FAILED-EMPTY":
         result[dimension] = "EMPTY"
+    elif status == "NO-CHANGE":
+        result[dimension] = "No Change"
     else:
         module.fail_json(msg=f"FAILED TO ADD AND UPDATE CUSTOM DIMENSIONS FOR {dimension}")
     return result
 
 
+def dimension_option(field, dimension):
+    '''Return the option creating the named custom dimension from a prefix attribute.'''
+    return functools.partial(add_with_dimension, field=field, dimension=dimension)
+
+
 def main():
     """
     Main function for the program.
@@ -631,35 +1594,71 @@ def main():
         enableCustomFields=dict(type="bool", required=False, default=False),
         customFieldName=dict(type="str", required=False),
         activeOnly=dict(type="bool", required=False, default=True),
-        email=dict(type="str", required=True),
-        token=dict(type="str", no_log=True, required=True),
-        region=dict(type="str", required=False, default="US", choices=["US", "EU"])
+        netboxFilters=dict(type="dict", required=False),
+        netboxApi=dict(type="str", required=False, default="rest", choices=["rest", "graphql"]),
+        netboxTrimFields=dict(type="bool", required=False, default=False),
+        netboxPageSize=dict(type="int", required=False, default=1000),
+        netboxWorkers=dict(type="int", required=False, default=4),
+        netboxStreaming=dict(type="bool", required=False, default=False),
+        prefixCache=dict(type="path", required=False),
+        kentikWorkers=dict(type="int", required=False, default=4),
+        checkpointFile=dict(type="path", required=False),
+        ignoreCheckpoints=dict(type="bool", required=False, default=False),
+        populatorSync=dict(type="str", required=False, default="replace", choices=["replace", "diff"]),
+        batchTimeout=dict(type="int", required=False, default=300),
+        batchPollInterval=dict(type="float", required=False, default=1),
+        batchPartBytes=dict(type="int", required=False, default=0),
+        gzipBodies=dict(type="bool", required=False, default=False),
+        gzipThreshold=dict(type="int", required=False, default=65536),
+        packPopulators=dict(type="bool", required=False, default=False),
+        populatorAddrLimit=dict(type="int", required=False, default=1000),
     )
+    argument_spec.update(client_argument_spec(catalog_cache=False))
     module = AnsibleModule(
         argument_spec=argument_spec,
         supports_check_mode=True,
     )
+    # Options run on worker threads, any of which may fail the module.
+    fail_once(module)
+    if module.params["netboxStreaming"] and not HAS_IJSON:
+        module.fail_json(msg=missing_required_lib("ijson"), exception=IJSON_IMPORT_ERROR)
     # Set the initial value of the ansible results.
     result = {"changed": False}
     # Create the initial warnings list. Add to this list as warnings occur.
     warnings = []
-    # Build Authentication dictionariies
-    kentik_auth = build_kentik_auth(module)
+    # Build the kentik client, one pooled session is shared by every option, upload and status poll.
+    client = KentikClient(module, pool_size=module.params["kentikWorkers"] * 2 + 1)
     netbox_auth = build_netbox_auth(module)
-    # Collec the prefixes from netbox
-    prefixes = collect_prefixes(module, netbox_auth)
-    decisions = gather_choices(module)
+    # The enabled options with the prefix attribute each one is grouped by.
+    decisions = {option: field for option, (field, choice) in gather_choices(module).items() if choice}
+    # Collec the prefixes from netbox and group them for every enabled option in one pass.
+    timings = client.timings
+    with timings.phase("fetch"):
+        if module.params["prefixCache"]:
+            prefixes = sync_prefix_store(module, netbox_auth, timings)
+        else:
+            prefixes = collect_prefixes(module, netbox_auth, timings)
+    with timings.phase("build"):
+        groups = group_prefixes(prefixes,
+                                list(decisions.values()),
+                                criteria_addr_limit(module))
     # For each choice that is true execute the corresponding key in the dictionary,
-    # which is the function.
+    # which is the function. The choices run concurrently up to the kentikWorkers cap
+    # and their results are kept in the order of the decisions.
     # Going to need to build a single jinja file for each choice
-    deploy_results = []
-    for option, choice in decisions.items():
-        if choice:
-            status = option(module,
-                            kentik_auth,
-                            warnings,
-                            prefixes)
-            deploy_results.append(status)
+    poller = BatchPoller(module, client, client.api_url("/batch"))
+    checkpoints = CheckpointStore(module.params["checkpointFile"],
+                                  f"{module.params['email']}@{module.params['region']}",
+                                  module.check_mode,
+                                  module.params["ignoreCheckpoints"])
+    # The custom dimensions in kentik are listed at most once, by the first option diffing against them.
+    dimensions = DimensionCatalog(client)
+    compressor = BodyCompressor(module)
+    # Once an option fails the options and uploads still queued are skipped.
+    deploy_results = run_concurrently(module, module.params["kentikWorkers"],
+                                      [functools.partial(option, module, client, warnings, poller,
+                                                         checkpoints, dimensions, compressor, groups)
+                                       for option in decisions])
     # Each function will be added to the deployment list with a pass or fail
     # and/or some other message.
     # We will log the deployment output and then return the deployment status
@@ -668,6 +1667,11 @@ def main():
         if "Success" in option.values():
             result["changed"] = True
     result["results"] = deploy_results
+    result["batch_timings"] = poller.timings
+    result["compression"] = compressor.report()
+    checkpoints.save()
+    if timings.enabled:
+        result["timings"] = timings.report()
     module.exit_json(**result)
 
 
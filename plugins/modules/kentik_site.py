@@ -43,13 +43,6 @@ options:
         description: Name of the Site Market this site belongs to.
         type: str
         default: ''
-    region:
-        description: The reqion that your Kentik portal is located in.
-        type: str
-        default: US
-        choices:
-            - US
-            - EU
     state:
         description: States whether to delete or create.
         type: str
@@ -57,14 +50,6 @@ options:
         choices:
             - present
             - absent
-    token:
-        description: The Kentik API Token used to authenticate.
-        type: str
-        required: true
-    email:
-        description: The Kentik API Email used to authenticate.
-        type: str
-        required: true
     infrastructureNetworks:
         description: Network subnets that connect to other network devices.
         type: list
@@ -78,6 +63,10 @@ options:
         type: list
         elements: str
 
+extends_documentation_fragment:
+- kentik.kentik_config.kentik_client
+- kentik.kentik_config.kentik_client.catalog_cache
+
 author:
 - Ethan Angele (@kentikethan)
 """
@@ -110,6 +99,16 @@ EXAMPLES = r"""
 
 RETURN = r"""
 # These are examples of possible return values, and in general should use other names for return values.
+timings:
+    description: The module run time and every http request with its latency, body bytes, retries and time
+                 waited on the rate limit, also summed per endpoint.
+    type: dict
+    returned: when collectTimings is enabled
+    sample: {"seconds": 0.9, "phases": {},
+             "endpoints": {"GET /site/v202211/sites": {"count": 1, "seconds": 0.31, "max_seconds": 0.31,
+                           "bytes_out": 0, "bytes_in": 20480, "retries": 0, "throttle_seconds": 0}},
+             "requests": [{"method": "GET", "endpoint": "/site/v202211/sites", "status": 200, "seconds": 0.31,
+                           "bytes_out": 0, "bytes_in": 20480, "retries": 0, "throttle_seconds": 0}]}
 original_message:
     description: The original name param that was passed in.
     type: str
@@ -123,24 +122,15 @@ message:
 """
 
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_text
-try:
-    import requests
-except ImportError:
-    HAS_ANOTHER_LIBRARY = False
-import json
+from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_client import (
+    KentikClient, client_argument_spec, payload_params)
 import logging
-import time
 logging.basicConfig(level=logging.INFO)
 
 
 def build_payload(module):
     """Build the payload"""
-    payload = module.params
-    del payload["email"]
-    del payload["token"]
-    del [payload["state"]]
-    del [payload["region"]]
+    payload = payload_params(module, exclude=("state",))
     if payload["infrastructureNetworks"] is None:
         payload["infrastructureNetworks"] = []
     if payload["userAccessNetworks"] is None:
@@ -159,14 +149,10 @@ def build_payload(module):
     return payload
 
 
-def gather_sites(base_url, api_version, auth, module):
+def gather_sites(client, api_version):
     """Gather a list of sites"""
-    url = f"{base_url}{api_version}/sites"
-    payload = {}
-    headers = auth
-    site_data = {}
-    response = http_request_func("GET", url, headers, payload, module)
-    site_data = response.json()
+    url = client.grpc_url(f"/site/{api_version}/sites")
+    site_data = client.catalog(url)
     site_dict = {}
     for site in site_data["sites"]:
         site_dict[site["title"]] = site["id"]
@@ -186,59 +172,31 @@ def compare_site(site_list, module):
     return function_return
 
 
-def http_request_func(method, url, headers, payload, module, retries=0):
-    """Function for hanlding HTTP Requests"""
-    if retries < 3:
-        try:
-            response = requests.request(
-                method, url, headers=headers, data=payload, timeout=30
-            )
-            if response.status_code == 200:
-                logging.info("%s HTTP Request Successfull for url: %s", method, url)
-            elif response.status_code == 429:
-                time.sleep(int(response.headers['x-ratelimit-reset']))
-                retries += 1
-                http_request_func(method, url, headers, payload, module, retries)
-            else:
-                module.fail_json(msg=response.text)
-            if int(response.headers['x-ratelimit-remaining']) < 10:
-                time.sleep(10)  # Helps to slow down the rate of execution for throttling.
-        except ConnectionError as exc:
-            module.fail_json(msg=to_text(exc))
-    else:
-        module.fail_json(msg=response.text)
-    return response
-
-
-def delete_site(base_url, api_version, auth, site_id, module):
+def delete_site(client, api_version, site_id):
     """Function to delete a site"""
     logging.info("Deleting Site...")
-    url = f"{base_url}{api_version}/sites/{site_id}"
-    payload = {}
-    headers = auth
-    http_request_func("DELETE", url, headers, payload, module)
+    url = client.grpc_url(f"/site/{api_version}/sites/{site_id}")
+    client.request("DELETE", url)
+    client.invalidate_catalog(client.grpc_url(f"/site/{api_version}/sites"))
     return "ok"
 
 
-def create_site(base_url, api_version, auth, site_object, module):
+def create_site(client, api_version, site_object):
     """Function for creating the site"""
     logging.info("Creating Site...")
-    url = f"{base_url}{api_version}/sites"
-    payload = json.dumps({"site": site_object})
-    headers = auth
-    response = http_request_func("POST", url, headers, payload, module)
+    url = client.grpc_url(f"/site/{api_version}/sites")
+    response = client.request("POST", url, payload={"site": site_object})
+    client.invalidate_catalog(url)
     site_data = response.json()
     return site_data["site"]["id"]
 
 
-def update_check(base_url, api_version, auth, site_id, site_object, module):
+def update_check(client, api_version, site_id, site_object):
     """Function to check whether a site needs to be updated"""
     logging.info("Checking site update...")
-    url = f"{base_url}{api_version}/sites/{site_id}"
-    headers = auth
+    url = client.grpc_url(f"/site/{api_version}/sites/{site_id}")
     site_data = {}
-    payload = {}
-    response = http_request_func("GET", url, headers, payload, module)
+    response = client.request("GET", url)
     site_data = response.json()
     return_bool = False
     if site_object["lat"] == 0.0:
@@ -262,15 +220,14 @@ def update_check(base_url, api_version, auth, site_id, site_object, module):
     return return_bool
 
 
-def update_site(base_url, api_version, auth, module, site_id, site_object):
+def update_site(client, api_version, site_id, site_object):
     """Function to update a site to kentik"""
     logging.info("Updating Site...")
-    url = f"{base_url}{api_version}/sites/{site_id}"
+    url = client.grpc_url(f"/site/{api_version}/sites/{site_id}")
     site_object['id'] = site_id
-    payload = json.dumps({"site": site_object})
-    headers = auth
     site_data = {}
-    response = http_request_func("PUT", url, headers, payload, module)
+    response = client.request("PUT", url, payload={"site": site_object})
+    client.invalidate_catalog(client.grpc_url(f"/site/{api_version}/sites"))
     site_data = response.json()
     return site_data["site"]["id"]
 
@@ -294,15 +251,13 @@ def main():
         ),
         lat=dict(type="float", required=False, default=0),
         lon=dict(type="float", required=False, default=0),
-        email=dict(type="str", required=True),
-        token=dict(type="str", no_log=True, required=True),
-        region=dict(type="str", required=False, default="US", choices=["US", "EU"]),
         state=dict(default="present", choices=["present", "absent"]),
         siteMarket=dict(type="str", required=False, default=""),
         infrastructureNetworks=dict(type="list", required=False, elements="str"),
         userAccessNetworks=dict(type="list", required=False, elements="str"),
         otherNetworks=dict(type="list", required=False, elements="str")
     )
+    argument_spec.update(client_argument_spec())
     module = AnsibleModule(
         argument_spec=argument_spec,
         supports_check_mode=True,
@@ -310,44 +265,36 @@ def main():
     result = {"changed": False}
     warnings = list()
     state = module.params["state"]
-    auth = {
-        "X-CH-Auth-Email": module.params["email"],
-        "X-CH-Auth-API-Token": module.params["token"],
-        "Content-Type": "application/json",
-    }
-    if module.params["region"] == "EU":
-        base_url = "https://grpc.api.kentik.eu/site/"
-    else:
-        base_url = "https://grpc.api.kentik.com/site/"
+    client = KentikClient(module)
     api_version = "v202211"
     site_object = build_payload(module)
-    site_list = gather_sites(base_url, api_version, auth, module)
+    site_list = gather_sites(client, api_version)
     site_id = compare_site(site_list, module)
 
     if site_id:
-        needs_updated = update_check(base_url,
+        needs_updated = update_check(client,
                                      api_version,
-                                     auth,
                                      site_id,
-                                     site_object,
-                                     module)
+                                     site_object)
         if state == "present" and needs_updated:
-            update_site(base_url, api_version, auth, module, site_id, site_object)
+            update_site(client, api_version, site_id, site_object)
             result["changed"] = True
             result["site_id"] = site_id
         elif state == "present":
             result["changed"] = False
             result["site_id"] = site_id
         elif state == "absent":
-            delete_site(base_url, api_version, auth, site_id, module)
+            delete_site(client, api_version, site_id)
             result["changed"] = True
     else:
         if state == "present":
-            site_id = create_site(base_url, api_version, auth, site_object, module)
+            site_id = create_site(client, api_version, site_object)
             result["changed"] = True
             result["site_id"] = site_id
         elif state == "absent":
             result["changed"] = False
+    if client.timings.enabled:
+        result["timings"] = client.timings.report()
     module.exit_json(**result)
 
 
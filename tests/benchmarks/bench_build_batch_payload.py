@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Micro-benchmark for build_batch_payload in the kentik_netbox_prefixes module.
+
+Times the payload build for growing numbers of prefixes where nearly every
+prefix carries a unique value, the worst case for the grouping, and prints
+the cost per prefix so linear scaling is easy to spot. The prefixes are
+loaded into a PrefixTable first, as the module collects them, so only the
+grouping and the src and dst payloads are timed.
+
+    python tests/benchmarks/bench_build_batch_payload.py --sizes 10000 100000 1000000
+"""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import gc
+import time
+
+from source_tree import load_module
+
+
+def synthetic_prefixes(size, cardinality):
+    """Build normalized prefixes with the given number of distinct descriptions"""
+    return [{"prefix": f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}/32",
+             "description": f"description {index % cardinality}"}
+            for index in range(size)]
+
+
+def main():
+    """Run the benchmark for each size"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 1000000])
+    parser.add_argument("--unique-ratio", type=float, default=0.9,
+                        help="Distinct values as a fraction of the prefix count.")
+    args = parser.parse_args()
+    module = load_module("kentik_netbox_prefixes")
+    module.logging.disable(module.logging.INFO)
+    baseline = None
+    print(f"{'prefixes':>10} {'values':>10} {'seconds':>10} {'us/prefix':>10} {'scaling':>8}")
+    for size in args.sizes:
+        cardinality = max(1, int(size * args.unique_ratio))
+        prefixes = module.PrefixTable(["description"])
+        for prefix in synthetic_prefixes(size, cardinality):
+            prefixes.append(prefix)
+        # Like timeit, keep the cyclic garbage collector out of the measurement.
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        module.build_batch_payload(prefixes, "description")
+        elapsed = time.perf_counter() - start
+        gc.enable()
+        per_prefix = elapsed / size * 1e6
+        if baseline is None:
+            baseline = per_prefix
+        print(f"{size:>10} {cardinality:>10} {elapsed:>10.3f} {per_prefix:>10.3f} {per_prefix / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
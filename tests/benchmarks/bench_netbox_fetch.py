@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Throughput comparison of the REST and GraphQL Netbox backends of kentik_netbox_prefixes.
+
+Collects every prefix from a Netbox instance through each backend and prints
+the wall time, prefixes per second, requests and bytes received, so the two can
+be compared against the same dataset.
+
+    python tests/benchmarks/bench_netbox_fetch.py --url https://netbox.example.com --token 0123abcd
+
+The url can also be that of the stand-in server in standin_server.py.
+"""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import time
+
+from source_tree import load_module
+
+
+class BenchModule:
+    """Stand in for AnsibleModule carrying only the params used to collect prefixes"""
+
+    def __init__(self, params):
+        self.params = params
+
+    def fail_json(self, **kwargs):
+        raise SystemExit(kwargs["msg"])
+
+
+def main():
+    """Collect the prefixes through each backend and report the throughput"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", required=True, help="The Netbox url.")
+    parser.add_argument("--token", required=True, help="The Netbox api token.")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--custom-field", default=None)
+    parser.add_argument("--trim-fields", action="store_true", help="Ask the REST api for the used fields only.")
+    parser.add_argument("--apis", nargs="+", default=["rest", "graphql"], choices=["rest", "graphql"])
+    args = parser.parse_args()
+    module = load_module("kentik_netbox_prefixes")
+    module.logging.disable(module.logging.INFO)
+    from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_timings import Timings
+    print(f"{'api':>8} {'prefixes':>10} {'seconds':>10} {'prefixes/s':>12} {'requests':>10} {'MB in':>10}")
+    for api in args.apis:
+        bench_module = BenchModule({"netboxUrl": args.url,
+                                    "netboxToken": args.token,
+                                    "netboxApi": api,
+                                    "netboxPageSize": args.page_size,
+                                    "netboxWorkers": args.workers,
+                                    "netboxStreaming": False,
+                                    "netboxFilters": None,
+                                    "netboxTrimFields": args.trim_fields,
+                                    "activeOnly": True,
+                                    "customFieldName": args.custom_field})
+        timings = Timings(True)
+        start = time.perf_counter()
+        prefixes = module.collect_prefixes(bench_module, module.build_netbox_auth(bench_module), timings)
+        elapsed = time.perf_counter() - start
+        mb_in = sum(record["bytes_in"] for record in timings.requests) / (1024 * 1024)
+        print(f"{api:>8} {len(prefixes):>10} {elapsed:>10.3f} {len(prefixes) / elapsed:>12.1f}"
+              f" {len(timings.requests):>10} {mb_in:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
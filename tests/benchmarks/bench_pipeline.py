@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Benchmark of the kentik_netbox_prefixes pipeline from Netbox to Kentik populators.
+
+Runs collect_prefixes, group_prefixes, add_to_sites and run_batch_url against
+the stand-in server for each dataset size. For every stage it reports the wall
+time, the peak RSS, the peak memory allocated by Python and the bytes the
+stage moves: the Netbox responses it reads, the serialized populator payloads
+it builds, or the request bodies it sends to Kentik.
+
+    python tests/benchmarks/bench_pipeline.py --sizes 10000 100000 1000000
+    python tests/benchmarks/bench_pipeline.py --save-baseline tests/benchmarks/baselines/pipeline.json
+    python tests/benchmarks/bench_pipeline.py --baseline tests/benchmarks/baselines/pipeline.json
+
+Each size runs in fresh processes against a fresh stand-in, once for the wall
+time and RSS and once under tracemalloc for the allocations, so the tracing
+never slows the timed run. With --baseline, the run exits 1 when a stage is
+slower or larger than the baseline by more than the tolerance. The wall times
+of a baseline only compare on the machine that recorded it.
+"""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+STANDIN = os.path.join(BENCH_DIR, "standin_server.py")
+STAGES = ("collect_prefixes", "group_prefixes", "add_to_sites", "run_batch_url")
+# Metric, allowed growth over the baseline, and the smallest baseline value that is compared at all.
+# Tiny values are mostly noise, so they never count as regressions.
+METRICS = (("seconds", "time_tolerance", 0.05),
+           ("rss_peak_mb", "memory_tolerance", 5),
+           ("alloc_peak_mb", "memory_tolerance", 1),
+           ("bytes", "bytes_tolerance", 1024))
+
+
+class BenchModule:
+    """Stand in for AnsibleModule carrying the params of the pipeline"""
+
+    def __init__(self, params):
+        self.params = params
+
+    def fail_json(self, **kwargs):
+        raise SystemExit(kwargs["msg"])
+
+
+def free_port():
+    """Return a port nothing is listening on"""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def fetch_stats(url):
+    """Return the request stats of the stand-in"""
+    with urllib.request.urlopen(f"{url}/_standin/stats", timeout=30) as response:
+        return json.loads(response.read())
+
+
+def wait_for_server(url, process):
+    """Block until the stand-in answers"""
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("The stand-in server exited before it was ready")
+        try:
+            return fetch_stats(url)
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit("The stand-in server did not start")
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process where the kernel allows it, returns False otherwise"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Return the peak RSS of this process in MB"""
+    try:
+        with open("/proc/self/status", encoding="utf-8") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and bytes on macOS, and never goes down.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def run_stages(options):
+    """Run the pipeline stages in this process and return their measurements"""
+    sys.path.insert(0, BENCH_DIR)
+    from source_tree import load_module
+
+    module = load_module("kentik_netbox_prefixes")
+    module.logging.disable(module.logging.INFO)
+    from ansible_collections.kentik.kentik_config.plugins.module_utils.kentik_timings import Timings
+
+    url = options["url"]
+    os.environ["KENTIK_BASE_URL"] = url
+    dimensions = options["dimensions"]
+    bench_module = BenchModule({"netboxUrl": url,
+                                "netboxToken": "benchmark",
+                                "netboxApi": "rest",
+                                "netboxPageSize": 1000,
+                                "netboxWorkers": 4,
+                                "netboxStreaming": options["streaming"],
+                                "netboxFilters": None,
+                                "netboxTrimFields": False,
+                                "activeOnly": True,
+                                "customFieldName": "POD",
+                                "email": "benchmark@example.com",
+                                "token": "benchmark",
+                                "region": "US",
+                                "rateLimitFile": options["rate_limit_file"],
+                                "kentikWorkers": 4,
+                                "batchPartBytes": 0,
+                                "batchPollInterval": 0.05,
+                                "batchTimeout": 300,
+                                "populatorSync": "replace",
+                                "gzipBodies": options["gzip"],
+                                "gzipThreshold": 65536,
+                                "packPopulators": options["pack"],
+                                "populatorAddrLimit": 1000})
+    module.fail_once(bench_module)
+    client = module.KentikClient(bench_module, pool_size=9)
+    poller = module.BatchPoller(bench_module, client, client.api_url("/batch"))
+    checkpoints = module.CheckpointStore(None, "benchmark")
+    dimension_catalog = module.DimensionCatalog(client)
+    compressor = module.BodyCompressor(bench_module)
+    warnings = []
+    state = {}
+
+    def collect():
+        state["prefixes"] = module.collect_prefixes(bench_module, module.build_netbox_auth(bench_module),
+                                                    Timings(False))
+
+    def group():
+        state["groups"] = module.group_prefixes(state["prefixes"], ["site", *dimensions],
+                                                module.criteria_addr_limit(bench_module))
+
+    def sites():
+        module.add_to_sites(bench_module, client, warnings, poller, checkpoints, dimension_catalog, compressor,
+                            state["groups"])
+
+    def batch():
+        for name in dimensions:
+            module.run_batch_url(bench_module, client, warnings, poller, checkpoints, dimension_catalog,
+                                 compressor, state["groups"][name], name)
+
+    def payload_bytes():
+        # The populators as serialized for kentik, measured outside of the timed stage.
+        return sum(len(chunk)
+                   for name in dimensions
+                   for direction in ("src", "dst")
+                   for chunk in module.iter_batch_body({"replace_all": True, "complete": True},
+                                                       state["groups"][name].upserts(direction)))
+
+    results = {}
+    for stage, run in zip(STAGES, (collect, group, sites, batch)):
+        before = fetch_stats(url)
+        reset_peak_rss()
+        if options["trace"]:
+            tracemalloc.start()
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        measured = {}
+        if options["trace"]:
+            measured["alloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+        else:
+            measured["seconds"] = seconds
+            measured["rss_peak_mb"] = peak_rss_mb()
+        after = fetch_stats(url)
+        if stage == "collect_prefixes":
+            measured["bytes"] = after["bytes_out"] - before["bytes_out"]
+        elif stage == "group_prefixes":
+            measured["bytes"] = payload_bytes()
+        else:
+            measured["bytes"] = after["bytes_in"] - before["bytes_in"]
+        results[stage] = measured
+    return results
+
+
+def run_pass(args, size, trace):
+    """Run one pass of a size in a child process against a fresh stand-in and return its measurements"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen([sys.executable, STANDIN,
+                               "--port", str(port),
+                               "--prefixes", str(size),
+                               "--cardinality", str(args.cardinality),
+                               "--v6-percent", str(args.v6_percent),
+                               "--sites", str(args.sites)],
+                              stdout=subprocess.DEVNULL)
+    try:
+        wait_for_server(url, server)
+        rate_limit_file = os.path.join(args.work_dir, f"bench_rate_limit_{port}.json")
+        options = {"url": url,
+                   "trace": trace,
+                   "dimensions": args.dimensions,
+                   "streaming": args.streaming,
+                   "gzip": args.gzip,
+                   "pack": args.pack,
+                   "rate_limit_file": rate_limit_file}
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(options)],
+                               stdout=subprocess.PIPE, check=True)
+        if os.path.exists(rate_limit_file):
+            os.remove(rate_limit_file)
+        return json.loads(child.stdout.decode("utf-8").splitlines()[-1])
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results, baseline, args):
+    """Return the regressions of the results against a baseline"""
+    tolerances = {"time_tolerance": args.time_tolerance,
+                  "memory_tolerance": args.memory_tolerance,
+                  "bytes_tolerance": args.bytes_tolerance}
+    regressions = []
+    for size, stages in results.items():
+        for stage, measured in stages.items():
+            expected = baseline.get("results", {}).get(size, {}).get(stage)
+            if expected is None:
+                continue
+            for metric, tolerance, floor in METRICS:
+                if metric not in measured or metric not in expected or expected[metric] < floor:
+                    continue
+                if measured[metric] > expected[metric] * (1 + tolerances[tolerance]):
+                    regressions.append(f"{size} {stage} {metric}: {measured[metric]:.3f} "
+                                       f"vs baseline {expected[metric]:.3f}")
+    return regressions
+
+
+def main():
+    """Run the pipeline for each size, report it and compare it with a baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 1000000])
+    parser.add_argument("--cardinality", type=int, default=1000,
+                        help="Distinct values of every dimension in the synthetic Netbox dataset.")
+    parser.add_argument("--v6-percent", type=int, default=10, help="Percentage of IPv6 prefixes.")
+    parser.add_argument("--sites", type=int, default=20, help="Number of sites the prefixes spread over.")
+    parser.add_argument("--dimensions", nargs="+", default=["tenant", "description"],
+                        help="Prefix fields uploaded as custom dimensions.")
+    parser.add_argument("--streaming", action="store_true", help="Parse the Netbox pages incrementally.")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the batch and site bodies.")
+    parser.add_argument("--pack", action="store_true", help="Pack the prefixes of a value into shared criteria.")
+    parser.add_argument("--baseline", help="Baseline json to compare with, exits 1 on a regression.")
+    parser.add_argument("--save-baseline", help="Write the results as a baseline json.")
+    parser.add_argument("--time-tolerance", type=float, default=0.5,
+                        help="Allowed wall time growth, 0.5 is 50%%, the stand-in and thread scheduling add noise.")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25,
+                        help="Allowed growth of the peak RSS and allocations, the concurrent fetches make them vary.")
+    parser.add_argument("--bytes-tolerance", type=float, default=0.02, help="Allowed growth of the bytes moved.")
+    parser.add_argument("--work-dir", default=BENCH_DIR, help="Directory for the rate limiter state of the runs.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_stages(json.loads(args.child))))
+        return
+    config = {"cardinality": args.cardinality, "v6_percent": args.v6_percent, "sites": args.sites,
+              "dimensions": args.dimensions, "streaming": args.streaming, "gzip": args.gzip, "pack": args.pack}
+    results = {}
+    print(f"{'prefixes':>10} {'stage':<18} {'seconds':>9} {'rss MB':>9} {'alloc MB':>9} {'bytes':>13}")
+    for size in args.sizes:
+        timed = run_pass(args, size, False)
+        traced = run_pass(args, size, True)
+        stages = {}
+        for stage in STAGES:
+            stages[stage] = {**timed[stage], "alloc_peak_mb": traced[stage]["alloc_peak_mb"]}
+            measured = stages[stage]
+            print(f"{size:>10} {stage:<18} {measured['seconds']:>9.3f} {measured['rss_peak_mb']:>9.1f} "
+                  f"{measured['alloc_peak_mb']:>9.1f} {measured['bytes']:>13}")
+        results[str(size)] = stages
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump({"config": config,
+                       "machine": {"python": platform.python_version(), "platform": platform.platform()},
+                       "results": results}, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config") != config:
+            print(f"The baseline was recorded with {baseline.get('config')}, not {config}")
+            sys.exit(2)
+        regressions = compare(results, baseline, args)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
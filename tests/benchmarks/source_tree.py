@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Load the collection modules straight from the source tree for the benchmarks.
+
+The modules import their shared code as ansible_collections.kentik.kentik_config,
+so the collection packages are mapped onto this checkout before a module is
+loaded, whether or not the collection is installed.
+"""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+PACKAGES = (("ansible_collections", None),
+            ("ansible_collections.kentik", None),
+            ("ansible_collections.kentik.kentik_config", ROOT),
+            ("ansible_collections.kentik.kentik_config.plugins", os.path.join(ROOT, "plugins")),
+            ("ansible_collections.kentik.kentik_config.plugins.module_utils",
+             os.path.join(ROOT, "plugins", "module_utils")))
+
+
+def map_collection():
+    """Register the collection packages so they resolve to this checkout"""
+    for name, path in PACKAGES:
+        package = sys.modules.get(name)
+        if package is None:
+            package = sys.modules[name] = types.ModuleType(name)
+            package.__path__ = []
+        if path is not None:
+            package.__path__ = [path]
+
+
+def load_module(name):
+    """Load a module of the collection from the source tree"""
+    map_collection()
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "plugins", "modules", f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
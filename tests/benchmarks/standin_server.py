@@ -0,0 +1,746 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Local stand-in for the Kentik and Netbox apis used by the modules of this collection.
+
+Serves the site, label, device, plan, custom dimension and batch endpoints of
+Kentik and the Netbox prefix REST and GraphQL endpoints from a generated, in
+memory dataset. Latency, Kentik rate limit headers, injected 429s and the
+dataset size are configurable, so the throughput of the modules can be measured
+without touching production or spending api quota.
+
+    python tests/benchmarks/standin_server.py --port 8800 --prefixes 100000 --latency 0.02 --rate-limit 200
+
+Point the modules at it with KENTIK_BASE_URL=http://127.0.0.1:8800 in the
+environment of the task and netboxUrl: http://127.0.0.1:8800. Set
+rateLimitFile to a file of its own so the limiter state of a real account is
+left alone. GET /_standin/stats returns the requests served so far.
+"""
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import gzip
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Timestamp of every generated prefix.
+LAST_UPDATED = "2024-01-01T00:00:00Z"
+# The address classifications of a kentik site.
+SITE_CLASSIFICATIONS = ("infrastructureNetworks", "userAccessNetworks", "otherNetworks")
+
+
+def build_parser():
+    """Return the parser of the server options, also used for the defaults of in process servers"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800, help="Port to listen on, 0 picks a free one.")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to every Kentik response.")
+    parser.add_argument("--netbox-latency", type=float, default=0, help="Seconds added to every Netbox response.")
+    parser.add_argument("--jitter", type=float, default=0, help="Random seconds up to this added to the latency.")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="Kentik requests allowed per window, 0 sends no rate limit headers.")
+    parser.add_argument("--rate-window", type=float, default=60, help="Seconds in a rate limit window.")
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="Share of Kentik requests answered with a 429 regardless of the rate limit.")
+    parser.add_argument("--batch-seconds", type=float, default=0,
+                        help="Seconds a completed batch takes before its status reports it complete.")
+    parser.add_argument("--prefixes", type=int, default=10000, help="Number of Netbox prefixes.")
+    parser.add_argument("--v6-percent", type=int, default=10, help="Percentage of the prefixes that are IPv6.")
+    parser.add_argument("--cardinality", type=int, default=100,
+                        help="Distinct tenant, vlan, role, description and custom field values.")
+    parser.add_argument("--sites", type=int, default=20, help="Number of Kentik sites, the prefixes spread over them.")
+    parser.add_argument("--labels", type=int, default=20, help="Number of Kentik labels.")
+    parser.add_argument("--devices", type=int, default=100, help="Number of Kentik devices.")
+    parser.add_argument("--plans", type=int, default=3, help="Number of Kentik plans.")
+    parser.add_argument("--max-page-size", type=int, default=1000, help="The Netbox MAX_PAGE_SIZE.")
+    parser.add_argument("--netbox-scopes", action="store_true",
+                        help="Assign the prefixes to their site through scope, like Netbox 4.2 and later.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected 429s and the jitter.")
+    return parser
+
+
+def build_config(**overrides):
+    """Return the default server options with overrides, e.g. build_config(prefixes=1000, port=0)"""
+    config = build_parser().parse_args([])
+    for name, value in overrides.items():
+        if not hasattr(config, name):
+            raise TypeError(f"Unknown stand-in option: {name}")
+        setattr(config, name, value)
+    return config
+
+
+def ipv4_prefix(index):
+    """Return the index-th /28 of 10.0.0.0/8"""
+    address = 0x0A000000 + ((index * 16) & 0xFFFFFF)
+    return f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}/28"
+
+
+def ipv6_prefix(index):
+    """Return the index-th /64 of 2001:db8::/32"""
+    return f"2001:db8:{index >> 16 & 0xFFFF:x}:{index & 0xFFFF:x}::/64"
+
+
+class PrefixDataset:
+    """Netbox prefixes generated from their id, so a million of them cost no memory until filtered"""
+
+    def __init__(self, config):
+        self.count = config.prefixes
+        self.v6_percent = config.v6_percent
+        self.cardinality = max(config.cardinality, 1)
+        self.sites = config.sites
+        self.scopes = config.netbox_scopes
+        self.lock = threading.Lock()
+        self.filtered = {}
+
+    def fields(self, prefix_id):
+        """Return the flat fields of a prefix"""
+        value = prefix_id % self.cardinality
+        if prefix_id % 100 < self.v6_percent:
+            prefix = ipv6_prefix(prefix_id)
+        else:
+            prefix = ipv4_prefix(prefix_id)
+        return {"id": prefix_id,
+                "prefix": prefix,
+                "status": "reserved" if prefix_id % 10 == 0 else "active",
+                # Every twentieth prefix has no site, like the unassigned space of a real IPAM.
+                "site": f"site-{prefix_id % self.sites}" if self.sites and prefix_id % 20 else None,
+                "tenant": f"tenant-{value}",
+                "vlan": f"vlan-{value}",
+                "role": f"role-{value % 10}",
+                "description": f"description-{value}",
+                "pod": f"pod-{value}"}
+
+    def rest_item(self, prefix_id):
+        """Return a prefix as the Netbox REST api does"""
+        fields = self.fields(prefix_id)
+
+        def nested(name, kind):
+            if fields[name] is None:
+                return None
+            nested_id = zlib.crc32(fields[name].encode("utf-8")) % 100000
+            return {"id": nested_id,
+                    "url": f"/api/{kind}/{nested_id}/",
+                    "display": fields[name],
+                    "name": fields[name]}
+        if self.scopes:
+            site = {"scope_type": "dcim.site" if fields["site"] is not None else None,
+                    "scope": nested("site", "dcim/sites")}
+        else:
+            site = {"site": nested("site", "dcim/sites")}
+        return {"id": prefix_id,
+                "url": f"/api/ipam/prefixes/{prefix_id}/",
+                "display": fields["prefix"],
+                "family": {"value": 6 if ":" in fields["prefix"] else 4},
+                "prefix": fields["prefix"],
+                "status": {"value": fields["status"], "label": fields["status"].title()},
+                **site,
+                "tenant": nested("tenant", "tenancy/tenants"),
+                "vlan": nested("vlan", "ipam/vlans"),
+                "role": nested("role", "ipam/roles"),
+                "description": fields["description"],
+                "custom_fields": {"POD": fields["pod"]},
+                "last_updated": LAST_UPDATED}
+
+    def graphql_item(self, prefix_id):
+        """Return a prefix as the prefix_list query of the Netbox GraphQL api does"""
+        fields = self.fields(prefix_id)
+        item = {"prefix": fields["prefix"],
+                "status": fields["status"],
+                "description": fields["description"],
+                "custom_fields": {"POD": fields["pod"]},
+                **{name: {"name": fields[name]} if fields[name] is not None else None
+                   for name in ("site", "tenant", "vlan", "role")}}
+        if self.scopes:
+            item["scope"] = item.pop("site")
+        return item
+
+    def matching(self, filters):
+        """Return the ids of the prefixes matching the filters, each filter matches any of its values"""
+        if not filters:
+            return range(1, self.count + 1)
+        key = tuple(sorted((name, tuple(values)) for name, values in filters.items()))
+        with self.lock:
+            if key not in self.filtered:
+                ids = array("i")
+                for prefix_id in range(1, self.count + 1):
+                    fields = self.fields(prefix_id)
+                    if all(self.matches(fields, name, values) for name, values in filters.items()):
+                        ids.append(prefix_id)
+                self.filtered[key] = ids
+            return self.filtered[key]
+
+    @staticmethod
+    def matches(fields, name, values):
+        """Return True when a prefix matches one filter"""
+        if name == "last_updated__gte":
+            return LAST_UPDATED >= values[0]
+        if name not in fields:
+            # Filters the stand-in does not model match everything.
+            return True
+        return str(fields[name]) in values
+
+
+class KentikState:
+    """The Kentik configuration served by the stand-in, changed by the requests it receives"""
+
+    def __init__(self, config):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000)
+        self.versions = {"sites": 0, "labels": 0, "devices": 0, "plans": 0, "customdimensions": 0}
+        self.sites = {}
+        for index in range(config.sites):
+            self.add_site({"title": f"site-{index}", "type": "SITE_TYPE_OTHER", "lat": 0, "lon": 0,
+                           "siteMarket": "", "postalAddress": None,
+                           "addressClassification": {name: [] for name in SITE_CLASSIFICATIONS}})
+        self.labels = {}
+        for index in range(config.labels):
+            self.add_label({"name": f"label-{index}", "color": "#5289D9"})
+        self.plans = [{"id": index + 1, "name": f"plan-{index}", "max_devices": 1000}
+                      for index in range(max(config.plans, 1))]
+        self.devices = {}
+        site_ids = list(self.sites) or [None]
+        for index in range(config.devices):
+            self.add_device({"deviceName": f"device-{index}",
+                             "deviceDescription": "Added by Ansible",
+                             "deviceSubtype": "router",
+                             "deviceSampleRate": 1,
+                             "sendingIps": [ipv4_prefix(index).split("/")[0]],
+                             "deviceBgpType": "none",
+                             "siteId": site_ids[index % len(site_ids)],
+                             "planId": self.plans[index % len(self.plans)]["id"]})
+        self.dimensions = {}
+        self.batches = {}
+
+    def next_id(self):
+        """Return a new object id"""
+        return str(next(self.ids))
+
+    def changed(self, collection):
+        """Bump the version of a collection so its ETag changes"""
+        self.versions[collection] += 1
+
+    def etag(self, collection):
+        """Return the ETag of a collection listing"""
+        return f'"{collection}-{self.versions[collection]}"'
+
+    def add_site(self, site):
+        """Store a new site and return it"""
+        site = {**site, "id": self.next_id()}
+        site.setdefault("addressClassification", {name: [] for name in SITE_CLASSIFICATIONS})
+        self.sites[site["id"]] = site
+        self.changed("sites")
+        return site
+
+    def add_label(self, label):
+        """Store a new label and return it"""
+        label = {**label, "id": self.next_id()}
+        self.labels[label["id"]] = label
+        self.changed("labels")
+        return label
+
+    def device_object(self, device_id, payload, labels):
+        """Return a device as the grpc device api does from a create or update payload"""
+        device = {key: value for key, value in payload.items() if key not in ("siteId", "planId", "id")}
+        device["id"] = device_id
+        device["site"] = {"id": payload.get("siteId")}
+        device["plan"] = {"id": payload.get("planId")}
+        device["labels"] = labels
+        return device
+
+    def add_device(self, payload):
+        """Store a new device and return it"""
+        device = self.device_object(self.next_id(), payload, [])
+        self.devices[device["id"]] = device
+        self.changed("devices")
+        return device
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Routes every request to the stand-in endpoint matching its method and path"""
+
+    protocol_version = "HTTP/1.1"
+    # (method, path pattern, handler name, api), the first match wins.
+    ROUTES = (
+        ("GET", r"/_standin/stats", "stats", "admin"),
+        ("GET", r"/api/ipam/prefixes/?", "netbox_prefixes", "netbox"),
+        ("POST", r"/graphql/?", "netbox_graphql", "netbox"),
+        ("GET", r"/site/[^/]+/sites", "list_sites", "kentik"),
+        ("POST", r"/site/[^/]+/sites", "create_site", "kentik"),
+        ("GET", r"/site/[^/]+/sites/(?P<id>[^/]+)", "get_site", "kentik"),
+        ("PUT", r"/site/[^/]+/sites/(?P<id>[^/]+)", "update_site", "kentik"),
+        ("DELETE", r"/site/[^/]+/sites/(?P<id>[^/]+)", "delete_site", "kentik"),
+        ("GET", r"/label/[^/]+/labels", "list_labels", "kentik"),
+        ("POST", r"/label/[^/]+/labels", "create_label", "kentik"),
+        ("DELETE", r"/label/[^/]+/labels/(?P<id>[^/]+)", "delete_label", "kentik"),
+        ("GET", r"/device/[^/]+/device", "list_devices", "kentik"),
+        ("POST", r"/device/[^/]+/device", "create_device", "kentik"),
+        ("GET", r"/device/[^/]+/device/(?P<id>[^/]+)", "get_device", "kentik"),
+        ("PUT", r"/device/[^/]+/device/(?P<id>[^/]+)", "update_device", "kentik"),
+        ("DELETE", r"/device/[^/]+/device/(?P<id>[^/]+)", "delete_device", "kentik"),
+        ("PUT", r"/device/[^/]+/device/(?P<id>[^/]+)/labels", "update_device_labels", "kentik"),
+        ("GET", r"/api/v5/plans", "list_plans", "kentik"),
+        ("GET", r"/api/v5/device/(?P<name>[^/]+)", "get_device_by_name", "kentik"),
+        ("GET", r"/api/v5/customdimensions", "list_dimensions", "kentik"),
+        ("POST", r"/api/v5/customdimension", "create_dimension", "kentik"),
+        ("POST", r"/api/v5/batch/customdimensions/(?P<name>[^/]+)/populators", "post_populators", "kentik"),
+        ("GET", r"/api/v5/batch/(?P<guid>[^/]+)/status", "batch_status", "kentik"),
+    )
+    COMPILED_ROUTES = tuple((method, re.compile(f"{pattern}$"), name, api) for method, pattern, name, api in ROUTES)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep the console quiet, the stats endpoint reports what was served"""
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def read_body(self):
+        """Read the request body, whether sent with a length or chunked, and gunzip it when needed"""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.stats.add("bytes_in", len(body))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def send_json(self, status, payload, headers=None):
+        """Send a json response with its length so the connection stays open"""
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats.add("bytes_out", len(body))
+
+    def dispatch(self, method):
+        """Find the route of the request, apply latency and rate limiting and answer it"""
+        parts = urlsplit(self.path)
+        body = self.read_body()
+        for route_method, pattern, name, api in self.COMPILED_ROUTES:
+            match = pattern.match(parts.path)
+            if match is None or route_method != method:
+                continue
+            break
+        else:
+            self.server.stats.count(f"{method} {parts.path}", 404)
+            self.send_json(404, {"error": f"No stand-in route for {method} {parts.path}"})
+            return
+        config = self.server.config
+        latency = config.netbox_latency if api == "netbox" else config.latency if api == "kentik" else 0
+        if latency or (config.jitter and api != "admin"):
+            time.sleep(latency + self.server.random(config.jitter))
+        headers = {}
+        if api == "kentik":
+            if not self.headers.get("X-CH-Auth-Email") or not self.headers.get("X-CH-Auth-API-Token"):
+                self.server.stats.count(name, 401)
+                self.send_json(401, {"error": "Missing X-CH-Auth-Email or X-CH-Auth-API-Token"})
+                return
+            allowed, headers = self.server.take_token()
+            if not allowed:
+                self.server.stats.count(name, 429)
+                self.send_json(429, {"error": "Too Many Requests"}, headers)
+                return
+        elif api == "netbox" and not self.headers.get("Authorization", "").startswith("Token "):
+            self.server.stats.count(name, 403)
+            self.send_json(403, {"detail": "Authentication credentials were not provided."})
+            return
+        try:
+            payload = json.loads(body) if body else None
+        except ValueError:
+            self.server.stats.count(name, 400)
+            self.send_json(400, {"error": "Request body is not valid json"})
+            return
+        query = parse_qs(parts.query)
+        status, response, extra_headers = getattr(self, name)(match.groupdict(), query, payload)
+        self.server.stats.count(name, status)
+        self.send_json(status, response, {**headers, **(extra_headers or {})})
+
+    # Stand-in administration.
+
+    def stats(self, _params, _query, _payload):
+        return 200, self.server.stats.report(), None
+
+    # Netbox.
+
+    def netbox_prefixes(self, _params, query, _payload):
+        dataset = self.server.prefixes
+        limit = min(int(query.pop("limit", ["50"])[0]) or self.server.config.max_page_size,
+                    self.server.config.max_page_size)
+        offset = int(query.pop("offset", ["0"])[0])
+        brief = query.pop("brief", ["0"])[0] not in ("0", "false", "False")
+        fields = query.pop("fields", [None])[0]
+        ids = dataset.matching(query)
+        results = []
+        for prefix_id in ids[offset:offset + limit]:
+            item = dataset.rest_item(prefix_id)
+            if brief:
+                item = {name: item[name] for name in ("id", "url", "display", "family", "prefix", "description")}
+            if fields:
+                item = {name: item[name] for name in fields.split(",") if name in item}
+            results.append(item)
+        return 200, {"count": len(ids),
+                     "next": None if offset + limit >= len(ids) else f"?limit={limit}&offset={offset + limit}",
+                     "previous": None if offset == 0 else f"?limit={limit}&offset={max(offset - limit, 0)}",
+                     "results": results}, None
+
+    def netbox_graphql(self, _params, _query, payload):
+        if not payload or "prefix_list" not in payload.get("query", ""):
+            return 200, {"data": None, "errors": [{"message": "The stand-in only serves the prefix_list query"}]}, None
+        # Netbox 4.2 replaced the site of a prefix with its scope, selecting the missing one is an error.
+        missing = "site" if self.server.config.netbox_scopes else "scope"
+        if re.search(rf"\b{missing}\s*{{", payload["query"]):
+            return 200, {"data": None,
+                         "errors": [{"message": f"Cannot query field '{missing}' on type 'PrefixType'."}]}, None
+        variables = payload.get("variables") or {}
+        pagination = variables.get("pagination") or {}
+        limit = pagination.get("limit", 100)
+        offset = pagination.get("offset", 0)
+        # Only plain value filters are modeled, lookups such as {"name": {"exact": ...}} match everything.
+        filters = {name: [str(value) for value in (values if isinstance(values, list) else [values])]
+                   for name, values in (variables.get("filters") or {}).items()
+                   if not isinstance(values, dict)}
+        dataset = self.server.prefixes
+        ids = dataset.matching(filters)
+        return 200, {"data": {"prefix_list": [dataset.graphql_item(prefix_id)
+                                              for prefix_id in ids[offset:offset + limit]]}}, None
+
+    # Kentik sites.
+
+    def catalog(self, collection, payload):
+        """Answer a catalog listing, a matching If-None-Match gets a 304"""
+        etag = self.server.state.etag(collection)
+        if self.headers.get("If-None-Match") == etag:
+            return 304, None, {"ETag": etag}
+        return 200, payload, {"ETag": etag}
+
+    def list_sites(self, _params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            return self.catalog("sites", {"sites": list(state.sites.values())})
+
+    def create_site(self, _params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            if any(site["title"] == payload["site"]["title"] for site in state.sites.values()):
+                return 409, {"error": f"Site {payload['site']['title']} already exists", "code": 6}, None
+            return 200, {"site": state.add_site(payload["site"])}, None
+
+    def get_site(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            if params["id"] not in state.sites:
+                return 404, {"error": "Site not found", "code": 5}, None
+            return 200, {"site": state.sites[params["id"]]}, None
+
+    def update_site(self, params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            if params["id"] not in state.sites:
+                return 404, {"error": "Site not found", "code": 5}, None
+            state.sites[params["id"]] = {**payload["site"], "id": params["id"]}
+            state.changed("sites")
+            return 200, {"site": state.sites[params["id"]]}, None
+
+    def delete_site(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            if state.sites.pop(params["id"], None) is None:
+                return 404, {"error": "Site not found", "code": 5}, None
+            state.changed("sites")
+            return 200, {}, None
+
+    # Kentik labels.
+
+    def list_labels(self, _params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            return self.catalog("labels", {"labels": list(state.labels.values())})
+
+    def create_label(self, _params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            return 200, {"label": state.add_label(payload["label"])}, None
+
+    def delete_label(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            if state.labels.pop(params["id"], None) is None:
+                return 404, {"error": "Label not found", "code": 5}, None
+            state.changed("labels")
+            return 200, {}, None
+
+    # Kentik devices and plans.
+
+    def list_devices(self, _params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            return self.catalog("devices", {"devices": list(state.devices.values())})
+
+    def create_device(self, _params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            name = payload["device"]["deviceName"]
+            if any(device["deviceName"] == name for device in state.devices.values()):
+                return 409, {"error": f"Device {name} already exists", "code": 6}, None
+            return 200, {"device": state.add_device(payload["device"])}, None
+
+    def get_device(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            if params["id"] not in state.devices:
+                return 404, {"error": "Device not found", "code": 5}, None
+            return 200, {"device": state.devices[params["id"]]}, None
+
+    def update_device(self, params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            device = state.devices.get(params["id"])
+            if device is None:
+                return 404, {"error": "Device not found", "code": 5}, None
+            # Site and plan are sent as ids and kept when an update leaves them out.
+            update = {"siteId": device["site"]["id"], "planId": device["plan"]["id"], **payload["device"]}
+            state.devices[params["id"]] = state.device_object(params["id"], update, device["labels"])
+            state.changed("devices")
+            return 200, {"device": state.devices[params["id"]]}, None
+
+    def delete_device(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            if state.devices.pop(params["id"], None) is None:
+                return 404, {"error": "Device not found", "code": 5}, None
+            state.changed("devices")
+            return 200, {}, None
+
+    def update_device_labels(self, params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            device = state.devices.get(params["id"])
+            if device is None:
+                return 404, {"error": "Device not found", "code": 5}, None
+            device["labels"] = [{"id": str(label["id"]), "name": state.labels.get(str(label["id"]), {}).get("name")}
+                                for label in payload["labels"]]
+            state.changed("devices")
+            return 200, {"device": device}, None
+
+    def list_plans(self, _params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            return self.catalog("plans", {"plans": state.plans})
+
+    def get_device_by_name(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            for device in state.devices.values():
+                if device["deviceName"] == params["name"]:
+                    return 200, {"device": {"id": device["id"], "device_name": device["deviceName"]}}, None
+            return 404, {"error": "Device not found"}, None
+
+    # Kentik custom dimensions and batches.
+
+    def list_dimensions(self, _params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            dimensions = []
+            for dimension in state.dimensions.values():
+                populators = [{"id": index, "value": value, "direction": populator["direction"],
+                               "addr": ",".join(populator["addr"])}
+                              for index, (value, populator) in enumerate(dimension["populators"].items())]
+                dimensions.append({**{key: value for key, value in dimension.items() if key != "populators"},
+                                   "populators": populators})
+            return self.catalog("customdimensions", {"customDimensions": dimensions})
+
+    def create_dimension(self, _params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            name = payload["name"]
+            if name.lower() in state.dimensions:
+                return 400, {"error": f"Custom dimension {name} already exists"}, None
+            dimension = {"id": int(state.next_id()), "name": name, "display_name": payload.get("display_name"),
+                         "type": payload.get("type", "string"), "populators": {}}
+            state.dimensions[name.lower()] = dimension
+            state.changed("customdimensions")
+            return 200, {"customDimension": {key: value for key, value in dimension.items()
+                                             if key != "populators"}}, None
+
+    def post_populators(self, params, _query, payload):
+        state = self.server.state
+        with state.lock:
+            dimension = state.dimensions.get(params["name"].lower())
+            if dimension is None:
+                return 400, {"error": f"Invalid column: {params['name']}"}, None
+            guid = payload.get("guid")
+            if guid is None:
+                guid = str(uuid.uuid4())
+                state.batches[guid] = {"completed_at": None, "upserts": 0, "deletes": 0}
+                if payload.get("replace_all"):
+                    dimension["populators"] = {}
+            elif guid not in state.batches:
+                return 400, {"error": f"Unknown batch guid {guid}"}, None
+            batch = state.batches[guid]
+            for delete in payload.get("deletes") or []:
+                dimension["populators"].pop(str(delete["value"]), None)
+                batch["deletes"] += 1
+            for upsert in payload.get("upserts") or []:
+                addresses = []
+                for criteria in upsert["criteria"]:
+                    addresses.extend(criteria["addr"])
+                dimension["populators"][str(upsert["value"])] = {"direction": upsert["criteria"][0]["direction"],
+                                                                 "addr": addresses}
+                batch["upserts"] += 1
+            if payload.get("complete", True):
+                batch["completed_at"] = time.monotonic()
+            state.changed("customdimensions")
+            return 200, {"message": "Batch accepted", "guid": guid}, None
+
+    def batch_status(self, params, _query, _payload):
+        state = self.server.state
+        with state.lock:
+            batch = state.batches.get(params["guid"])
+            if batch is None:
+                return 404, {"error": "Batch not found"}, None
+            completed_at = batch["completed_at"]
+            is_complete = (completed_at is not None
+                           and time.monotonic() - completed_at >= self.server.config.batch_seconds)
+            return 200, {"guid": params["guid"],
+                         "is_complete": is_complete,
+                         "upserts": {"total": batch["upserts"]},
+                         "deletes": {"total": batch["deletes"]}}, None
+
+
+class Stats:
+    """Counts of the requests served per route and status"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.totals = {"requests": 0, "throttled": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def count(self, route, status):
+        """Count one answered request"""
+        with self.lock:
+            statuses = self.routes.setdefault(route, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            self.totals["requests"] += 1
+            if status == 429:
+                self.totals["throttled"] += 1
+
+    def add(self, name, value):
+        """Add to a total"""
+        with self.lock:
+            self.totals[name] += value
+
+    def report(self):
+        """Return the counts"""
+        with self.lock:
+            return {**self.totals, "routes": {route: dict(statuses) for route, statuses in self.routes.items()}}
+
+
+class StandinServer(ThreadingHTTPServer):
+    """Threaded http server holding the dataset, the Kentik state and the rate limit window"""
+
+    daemon_threads = True
+
+    def __init__(self, config):
+        super().__init__((config.host, config.port), StandinHandler)
+        self.config = config
+        self.prefixes = PrefixDataset(config)
+        self.state = KentikState(config)
+        self.stats = Stats()
+        self.rng = random.Random(config.seed)
+        self.rate_lock = threading.Lock()
+        self.window_started = time.monotonic()
+        self.window_used = 0
+
+    @property
+    def url(self):
+        """Return the base url to point the modules at"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def random(self, scale):
+        """Return a random float up to scale"""
+        if not scale:
+            return 0
+        with self.rate_lock:
+            return self.rng.random() * scale
+
+    def take_token(self):
+        """Count a Kentik request against the window, returns whether it is allowed and the rate limit headers"""
+        config = self.config
+        with self.rate_lock:
+            now = time.monotonic()
+            if now - self.window_started >= config.rate_window:
+                self.window_started = now
+                self.window_used = 0
+            injected = config.throttle_rate and self.rng.random() < config.throttle_rate
+            allowed = not injected and (not config.rate_limit or self.window_used < config.rate_limit)
+            if allowed:
+                self.window_used += 1
+            if not config.rate_limit:
+                return allowed, {}
+            reset = max(self.window_started + config.rate_window - now, 0)
+            return allowed, {"x-ratelimit-limit": str(config.rate_limit),
+                             "x-ratelimit-remaining": str(max(config.rate_limit - self.window_used, 0)),
+                             "x-ratelimit-reset": f"{reset:.3f}"}
+
+
+def start_server(config=None, **overrides):
+    """Start a stand-in server on a background thread and return it, call shutdown() to stop it"""
+    if config is None:
+        config = build_config(**{"port": 0, **overrides})
+    server = StandinServer(config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    """Serve the stand-in apis until interrupted"""
+    config = build_parser().parse_args()
+    server = StandinServer(config)
+    print(f"Serving the Kentik and Netbox stand-in on {server.url} with {config.prefixes} prefixes")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()